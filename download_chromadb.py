@@ -3,13 +3,18 @@
 """
 🔽 PIPILA v8.5 FINAL - Document Processor with BATCH MODE
 Creates ChromaDB from documents on each deploy
+
+The bot also runs it in the background (`--output <new dir>`) to rebuild the
+index while it keeps serving from the current one.
 """
 
 import os
 import sys
+import argparse
 import urllib.request
 import zipfile
 import shutil
+import tempfile
 import time
 from pathlib import Path
 
@@ -20,28 +25,24 @@ def log(msg):
     print(f"[PROCESSOR] {msg}", flush=True)
     sys.stdout.flush()
 
-def download_documents():
-    """Download documents ZIP from GitHub Releases"""
+def download_documents(work_dir):
+    """Download documents ZIP from GitHub Releases into `work_dir` (private to this build)"""
     
     github_url = "https://github.com/ErnestKostevich/pipila-bot1/releases/download/v8.2/Fuentes.de.informacion.RAG-20251207T164947Z-3-001.zip"
     
-    zip_path = "/tmp/documents.zip"
-    extract_dir = "/tmp/documents"
+    zip_path = os.path.join(work_dir, "documents.zip")
+    extract_dir = os.path.join(work_dir, "documents")
     
     log("=" * 70)
     log("🔽 Downloading Documents from GitHub")
     log("=" * 70)
     
-    # Clean old folders
-    for path in [zip_path, extract_dir, CHROMA_PATH]:
-        if os.path.exists(path):
-            try:
-                if os.path.isdir(path):
-                    shutil.rmtree(path)
-                else:
-                    os.remove(path)
-            except:
-                pass
+    # Clean the previous index in the output folder
+    if os.path.exists(CHROMA_PATH):
+        try:
+            shutil.rmtree(CHROMA_PATH)
+        except:
+            pass
     
     log(f"📥 Downloading...")
     start_time = time.time()
@@ -311,6 +312,11 @@ def create_chromadb(documents_dir):
     return len(all_chunks)
 
 def main():
+    global CHROMA_PATH
+    parser = argparse.ArgumentParser(description="Build the PIPILA ChromaDB index")
+    parser.add_argument('--output', default=CHROMA_PATH, help="index directory (replaced if it exists)")
+    CHROMA_PATH = parser.parse_args().output
+    
     log("=" * 70)
     log("🚀 PIPILA v8.5 FINAL - BATCH MODE")
     log("=" * 70)
@@ -318,8 +324,16 @@ def main():
     
     total_start = time.time()
     
-    # Download documents
-    documents_dir = download_documents()
+    # Download documents (temp dir per build, so concurrent builds don't share files)
+    work_dir = tempfile.mkdtemp(prefix="pipila_documents_")
+    try:
+        return build_index(work_dir, total_start)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def build_index(work_dir, total_start):
+    """Download, extract and index the documents, using `work_dir` for the files"""
+    documents_dir = download_documents(work_dir)
     
     # Install pptx if needed
     try:
@@ -331,13 +345,6 @@ def main():
     # Create ChromaDB with BATCH MODE
     total_chunks = create_chromadb(documents_dir)
     
-    # Cleanup
-    log("🧹 Cleaning up...")
-    try:
-        shutil.rmtree(documents_dir)
-    except:
-        pass
-    
     total_time = time.time() - total_start
     
     log("")
@@ -348,8 +355,6 @@ def main():
     log(f"📁 Path: {CHROMA_PATH}")
     log(f"⏱️ Total: {total_time/60:.1f} minutes")
     log("=" * 70)
-    log("")
-    log("✅ Starting bot...")
     
     return 0
 
@@ -9,22 +9,44 @@ Professional Financial Assistant for Oscar Casco Team
 """
 import os
 import sys
+import re
+import csv
+import hmac
+import hashlib
+import fcntl
+import gzip
 import json
+import math
+import shutil
+import signal
+import time
+import tempfile
+import threading
+import random
 import logging
 import asyncio
-from datetime import datetime
-from typing import List, Dict
+# Startup timing starts before the third-party imports
+STARTUP_STARTED = time.perf_counter()
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import List, Dict, Tuple, Optional, Callable, Awaitable, BinaryIO
 from pathlib import Path
 
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler
+from telegram import Update, Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, ContextTypes, filters, CallbackQueryHandler
 from telegram.constants import ParseMode
-import google.generativeai as genai
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, Text, BigInteger
+from aiohttp import web
+from google.api_core import exceptions as google_exceptions
+from sqlalchemy import create_engine, event, select, insert, update, delete, case, func, Index, Column, Integer, String, Boolean, Date, DateTime, Text, BigInteger
 from sqlalchemy.orm import sessionmaker, declarative_base
-import chromadb
-import PyPDF2
-import docx
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # only needed for STATE_BACKEND=redis
+    aioredis = None
 
 # ============================================================================
 # CONFIGURATION
@@ -38,6 +60,125 @@ CREATOR_ID = None
 BOT_VERSION = "9.0 PRO"
 BOT_START_TIME = datetime.now()
 
+# Gemini quotas (requests / tokens per minute) and resilience settings
+GEMINI_RPM = int(os.getenv('GEMINI_RPM', '15'))
+GEMINI_TPM = int(os.getenv('GEMINI_TPM', '1000000'))
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '4'))
+GEMINI_BACKOFF_BASE = float(os.getenv('GEMINI_BACKOFF_BASE', '1.0'))
+GEMINI_BACKOFF_MAX = float(os.getenv('GEMINI_BACKOFF_MAX', '30'))
+GEMINI_BREAKER_THRESHOLD = int(os.getenv('GEMINI_BREAKER_THRESHOLD', '5'))
+GEMINI_BREAKER_COOLDOWN = float(os.getenv('GEMINI_BREAKER_COOLDOWN', '60'))
+
+# Fair scheduling of expensive work (LLM + retrieval): concurrent slots and per-user rate
+LLM_WORKERS = int(os.getenv('LLM_WORKERS', '4'))
+USER_RATE_PER_MIN = float(os.getenv('USER_RATE_PER_MIN', '6'))
+USER_BURST = int(os.getenv('USER_BURST', '3'))
+
+# RAG context packing
+RAG_CANDIDATES = int(os.getenv('RAG_CANDIDATES', '10'))
+RAG_CONTEXT_TOKENS = int(os.getenv('RAG_CONTEXT_TOKENS', '1200'))
+RAG_MMR_LAMBDA = float(os.getenv('RAG_MMR_LAMBDA', '0.7'))
+# Relevance cutoff (similarity in [0, 1]) and adaptive k
+RAG_MIN_SIMILARITY = float(os.getenv('RAG_MIN_SIMILARITY', '0.35'))
+RAG_RELATIVE_MARGIN = float(os.getenv('RAG_RELATIVE_MARGIN', '0.15'))
+RAG_MAX_K = int(os.getenv('RAG_MAX_K', '6'))
+
+# Seconds a user row stays in the in-memory cache
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', '300'))
+
+# Write-behind query log: flush every N seconds or once this many rows are buffered
+QUERY_FLUSH_INTERVAL = float(os.getenv('QUERY_FLUSH_INTERVAL', '5'))
+QUERY_FLUSH_SIZE = int(os.getenv('QUERY_FLUSH_SIZE', '50'))
+QUERY_BUFFER_MAX = int(os.getenv('QUERY_BUFFER_MAX', '5000'))
+
+# Database driver mode ('async' = SQLAlchemy asyncio, 'sync' = classic sessions) and pool
+DB_BACKEND = os.getenv('DB_BACKEND', 'async')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+
+# Offline store used when DATABASE_URL is not set
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'pipila.db')
+
+# Query log retention (days, 0 keeps everything) and background pruning
+QUERY_RETENTION_DAYS = int(os.getenv('QUERY_RETENTION_DAYS', '180'))
+QUERY_PRUNE_BATCH = int(os.getenv('QUERY_PRUNE_BATCH', '5000'))
+QUERY_PRUNE_INTERVAL = int(os.getenv('QUERY_PRUNE_INTERVAL', str(6 * 3600)))
+
+# Analytics: daily summary refresh (seconds) and /team page size
+STATS_REFRESH_INTERVAL = int(os.getenv('STATS_REFRESH_INTERVAL', '600'))
+TEAM_PAGE_SIZE = int(os.getenv('TEAM_PAGE_SIZE', '15'))
+
+# Rows fetched per round-trip when streaming the query log
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '1000'))
+
+# Update delivery: 'polling' or 'webhook' (embedded HTTP server)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # public base URL; setWebhook is skipped when unset
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', os.getenv('WEBHOOK_PORT', '8080')))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+
+# Updates handled in parallel across users (each user's updates stay in order)
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '32'))
+
+# Seconds a question waits for the knowledge base to finish opening after a cold start
+KNOWLEDGE_WAIT_TIMEOUT = float(os.getenv('KNOWLEDGE_WAIT_TIMEOUT', '30'))
+
+# Warm-up after startup (embedding model, index pages, frequent questions) and retrieval cache
+WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', '1') != '0'
+RETRIEVAL_CACHE_SIZE = int(os.getenv('RETRIEVAL_CACHE_SIZE', '256'))
+
+# Knowledge base rebuilds: builder script run in a subprocess, auto-build when the index is
+# empty, and the minimum size of a new index relative to the current one to accept the swap
+INDEX_BUILDER = os.getenv('INDEX_BUILDER', str(Path(__file__).with_name('download_chromadb.py')))
+INDEX_AUTO_BUILD = os.getenv('INDEX_AUTO_BUILD', '1') != '0'
+INDEX_MIN_RATIO = float(os.getenv('INDEX_MIN_RATIO', '0.5'))
+# Seconds between checks for a build swapped in by another worker
+INDEX_FOLLOW_INTERVAL = int(os.getenv('INDEX_FOLLOW_INTERVAL', '60'))
+
+# Uploads: size limit (Telegram bots can download up to 20 MB), pages/slides parsed,
+# bytes kept in RAM before spilling to a temp file, and parser threads
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', str(20 * 1024 * 1024)))
+UPLOAD_MAX_PAGES = int(os.getenv('UPLOAD_MAX_PAGES', '200'))
+UPLOAD_SPOOL_BYTES = int(os.getenv('UPLOAD_SPOOL_BYTES', str(4 * 1024 * 1024)))
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', '2'))
+
+# Recent uploads kept with their extracted text and answers (per caption and language)
+UPLOAD_CACHE_FILES = int(os.getenv('UPLOAD_CACHE_FILES', '64'))
+UPLOAD_CACHE_TTL = int(os.getenv('UPLOAD_CACHE_TTL', str(24 * 3600)))
+UPLOAD_CACHE_ANSWERS = int(os.getenv('UPLOAD_CACHE_ANSWERS', '8'))
+
+# Long uploads: files up to FILE_DIRECT_CHARS go to Gemini whole; longer ones are summarised
+# map-reduce style in up to FILE_MAX_SECTIONS sections (FILE_SECTION_CONCURRENCY at a time,
+# each charged to the uploader's rate limit), and indexed per user (chunks like
+# download_chromadb.py) so questions retrieve only the relevant parts
+FILE_DIRECT_CHARS = int(os.getenv('FILE_DIRECT_CHARS', '12000'))
+FILE_SECTION_CHARS = int(os.getenv('FILE_SECTION_CHARS', '20000'))
+FILE_MAX_SECTIONS = int(os.getenv('FILE_MAX_SECTIONS', '8'))
+FILE_SECTION_CONCURRENCY = int(os.getenv('FILE_SECTION_CONCURRENCY', '2'))
+FILE_CONTEXT_TOKENS = int(os.getenv('FILE_CONTEXT_TOKENS', '2500'))
+UPLOAD_CHUNK_CHARS = 1000
+UPLOAD_CHUNK_OVERLAP = 200
+UPLOAD_INDEX_TTL = int(os.getenv('UPLOAD_INDEX_TTL', str(2 * 3600)))
+UPLOAD_INDEX_MAX_CHUNKS = int(os.getenv('UPLOAD_INDEX_MAX_CHUNKS', '3000'))
+
+# Language auto-switch: minimum letters and confidence per message, and how many
+# confident messages in a row it takes to switch
+LANG_MIN_LETTERS = int(os.getenv('LANG_MIN_LETTERS', '15'))
+LANG_MIN_CONFIDENCE = float(os.getenv('LANG_MIN_CONFIDENCE', '0.95'))
+LANG_SWITCH_STREAK = int(os.getenv('LANG_SWITCH_STREAK', '2'))
+
+# Conversation history, language and creator state: 'memory' (one worker) or 'redis' (shared)
+REDIS_URL = os.getenv('REDIS_URL')
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'redis' if REDIS_URL else 'memory')
+STATE_PREFIX = os.getenv('STATE_PREFIX', 'pipila')
+SESSION_MAX_TURNS = int(os.getenv('SESSION_MAX_TURNS', '10'))  # question/answer pairs kept
+SESSION_TTL = int(os.getenv('SESSION_TTL', str(7 * 86400)))
+USERS_JSON_PATH = 'users.json'
+
 logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s',
     level=logging.INFO,
@@ -49,6 +190,11 @@ if not BOT_TOKEN or not GEMINI_API_KEY:
     logger.error("❌ Missing BOT_TOKEN or GEMINI_API_KEY")
     sys.exit(1)
 
+if BOT_MODE == 'webhook' and WEBHOOK_URL and not WEBHOOK_SECRET:
+    # A public endpoint without the secret would accept forged updates (e.g. as the creator)
+    logger.error("❌ WEBHOOK_URL requires WEBHOOK_SECRET")
+    sys.exit(1)
+
 # ============================================================================
 # PROFESSIONAL TRANSLATIONS (ES/DE)
 # ============================================================================
@@ -161,10 +307,14 @@ Puedes copiar y adaptar estas preguntas.""",
 
         # System
         'thinking': '⏳ Consultando...',
+        'ai_unavailable': '⚠️ El asistente está saturado en este momento. Inténtalo de nuevo en unos minutos.',
+        'queued': '⏳ En cola: posición {position}',
+        'rate_limited': '🐢 Demasiadas consultas seguidas. Espera {seconds}s.',
         'error': '❌ Error: {error}',
         'cleared': '✅ Conversación reiniciada',
         'file_processed': '<b>📄 {filename}</b>\n\n{response}',
         'file_error': '❌ Error al procesar archivo',
+        'file_too_large': '⚠️ Archivo demasiado grande (máx. {limit} MB)',
         'admin_only': '🔒 Solo administradores',
         'user_added': '✅ Usuario {id} añadido al equipo',
         'no_access': '🔒 Solo para el equipo de Oscar.\nContacta al administrador.',
@@ -296,10 +446,14 @@ Beispiele nützlicher Fragen:
 Du kannst diese Fragen kopieren und anpassen.""",
 
         'thinking': '⏳ Suche...',
+        'ai_unavailable': '⚠️ Der Assistent ist gerade überlastet. Bitte versuche es in ein paar Minuten erneut.',
+        'queued': '⏳ In der Warteschlange: Position {position}',
+        'rate_limited': '🐢 Zu viele Anfragen hintereinander. Warte {seconds}s.',
         'error': '❌ Fehler: {error}',
         'cleared': '✅ Gespräch neu gestartet',
         'file_processed': '<b>📄 {filename}</b>\n\n{response}',
         'file_error': '❌ Fehler beim Verarbeiten',
+        'file_too_large': '⚠️ Datei zu groß (max. {limit} MB)',
         'admin_only': '🔒 Nur für Administratoren',
         'user_added': '✅ Benutzer {id} zum Team hinzugefügt',
         'no_access': '🔒 Nur für Oscar Team.\nKontaktiere den Administrator.',
@@ -332,18 +486,111 @@ def get_text(lang: str, key: str, **kwargs) -> str:
     text = TRANSLATIONS.get(lang, TRANSLATIONS['es']).get(key, key)
     return text.format(**kwargs) if kwargs else text
 
-def detect_language(text: str) -> str:
-    text_lower = text.lower()
-    de_words = ['was', 'wie', 'wo', 'wann', 'warum', 'ist', 'sind', 'haben']
-    es_words = ['qué', 'cómo', 'dónde', 'cuándo', 'por qué', 'es', 'son']
-    de_count = sum(1 for word in de_words if word in text_lower)
-    es_count = sum(1 for word in es_words if word in text_lower)
-    return 'de' if de_count > es_count else 'es'
+# Frequent words per language; the bot's own texts are added to the profiles below
+LANGUAGE_SAMPLES = {
+    'es': """el la los las de del que y en un una es son por con para no se su sus al lo como más pero
+    le ya o este esta sí porque entre cuando muy sin sobre también me hasta hay donde quien desde
+    todo nos todos uno les ni otros ese eso ante ellos esto antes algunos qué unos yo otro otra él
+    tanto esa estos mucho nada cual poco ella estar algo nosotros cuánto cómo dónde cuándo necesito
+    tiene puedo quiero hacer cliente clientes seguro seguros póliza pólizas contrato ahorro vivienda
+    préstamo hipoteca jubilación pensión familia empresa trabajo dinero pago mensual anual cuota""",
+    'de': """der die das und in den von zu mit sich des auf für ist im dem nicht ein eine einen einem
+    als auch es an werden aus er hat dass sie nach wird bei einer um am sind noch wie über so zum
+    war haben nur oder aber vor zur bis mehr durch man sein wurde wenn ich du wir ihr was wo wann
+    warum welche welcher können kann muss brauche möchte gibt kunde kunden versicherung
+    versicherungen vertrag verträge sparen bausparen darlehen rente altersvorsorge familie
+    unternehmen arbeit geld zahlung monatlich jährlich beitrag schutz leistung""",
+}
+
+class LanguageDetector:
+    """Naive Bayes over character trigrams: returns the likeliest language and a confidence.
+
+    The confidence is a posterior over the average per-trigram log-likelihood (times
+    `evidence`), so it measures how clearly the text leans one way, not how long it is.
+    """
+
+    def __init__(self, samples: Dict[str, str], evidence: float = 5.0):
+        self.evidence = evidence
+        self.log_probs = {}
+        self.unseen = {}
+        for lang, sample in samples.items():
+            counts = {}
+            for gram in self._trigrams(sample):
+                counts[gram] = counts.get(gram, 0) + 1
+            total = sum(counts.values()) + len(counts) + 1
+            self.log_probs[lang] = {gram: math.log((n + 1) / total) for gram, n in counts.items()}
+            self.unseen[lang] = math.log(1 / total)
+
+    @staticmethod
+    def _trigrams(text: str) -> List[str]:
+        grams = []
+        for word in re.findall(r"[^\W\d_]+", text.lower()):
+            padded = f" {word} "
+            grams += [padded[i:i + 3] for i in range(len(padded) - 2)]
+        return grams
+
+    def detect(self, text: str) -> Tuple[Optional[str], float]:
+        grams = self._trigrams(text)
+        if not grams:
+            return None, 0.0
+        scores = {
+            lang: self.evidence * sum(probs.get(gram, self.unseen[lang]) for gram in grams) / len(grams)
+            for lang, probs in self.log_probs.items()
+        }
+        best = max(scores, key=scores.get)
+        total = sum(math.exp(score - scores[best]) for score in scores.values())
+        return best, 1 / total
+
+def _language_corpus(lang: str) -> str:
+    def strings(value):
+        if isinstance(value, dict):
+            return [s for v in value.values() for s in strings(v)]
+        return [value] if isinstance(value, str) else []
+    texts = strings(TRANSLATIONS[lang])
+    return LANGUAGE_SAMPLES[lang] + "\n" + re.sub(r'<[^>]+>|\{\w+\}', ' ', "\n".join(texts))
+
+language_detector = LanguageDetector({lang: _language_corpus(lang) for lang in TRANSLATIONS})
+language_streaks = {}  # user_id -> (candidate language, confident messages in a row)
+
+def detect_language(text: str) -> Tuple[Optional[str], float]:
+    if sum(ch.isalpha() for ch in text) < LANG_MIN_LETTERS:
+        return None, 0.0
+    return language_detector.detect(text)
+
+def language_switch(user_id: int, text: str, current_lang: str) -> Optional[str]:
+    """New language for the user, or None to stay.
+
+    Only confident detections count, and it takes LANG_SWITCH_STREAK of them in a row,
+    so one German product name in a Spanish question does not reset the session.
+    """
+    lang, confidence = detect_language(text)
+    if lang is None or confidence < LANG_MIN_CONFIDENCE:
+        return None
+    if lang == current_lang:
+        language_streaks.pop(user_id, None)
+        return None
+    candidate, streak = language_streaks.get(user_id, (lang, 0))
+    streak = streak + 1 if candidate == lang else 1
+    if streak >= LANG_SWITCH_STREAK:
+        language_streaks.pop(user_id, None)
+        return lang
+    language_streaks[user_id] = (lang, streak)
+    return None
 
 # ============================================================================
 # GEMINI AI
 # ============================================================================
-genai.configure(api_key=GEMINI_API_KEY)
+genai = None  # google.generativeai, imported by load_genai()
+
+def load_genai():
+    """Import and configure the Gemini SDK on first use; the import alone takes ~0.5s"""
+    global genai
+    if genai is None:
+        import google.generativeai as sdk
+        sdk.configure(api_key=GEMINI_API_KEY)
+        genai = sdk
+        logger.info("✅ Gemini configured")
+    return genai
 
 generation_config = {
     "temperature": 0.7,
@@ -395,105 +642,582 @@ WISSEN:
 Sei praktisch und hilfreich."""
 }
 
-model_text = genai.GenerativeModel(
-    model_name='gemini-2.5-flash',
-    generation_config=generation_config,
-    safety_settings=safety_settings
+# ============================================================================
+# GEMINI CLIENT (rate limiting, backoff, circuit breaker)
+# ============================================================================
+RETRYABLE_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+    asyncio.TimeoutError,
+    ConnectionError,
 )
 
-logger.info("✅ Gemini configured")
+class GeminiUnavailableError(Exception):
+    """Raised when Gemini cannot be reached and no retry is worthwhile"""
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (~4 characters per token)"""
+    return max(1, len(text) // 4)
+
+class TokenBucket:
+    """Async token bucket refilled continuously at `rate` tokens per second"""
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1):
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def try_take(self, amount: float = 1) -> float:
+        """Take tokens without waiting; returns 0 on success, else seconds until available"""
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+    
+    def consume(self, amount: float):
+        """Adjust the bucket after the fact; may go negative (debt)"""
+        self._refill()
+        self.tokens -= amount
+
+class CircuitBreaker:
+    """Opens after consecutive failures, half-opens after a cooldown"""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None  # when the half-open probe was let through
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.cooldown:
+            return False
+        # Half-open: a single probe at a time (a lost probe expires after another cooldown)
+        if self.probe_at is not None and now - self.probe_at < self.cooldown:
+            return False
+        self.probe_at = now
+        return True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("✅ Gemini circuit closed")
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+
+    def record_failure(self):
+        self.probe_at = None
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.warning(f"⚠️ Gemini circuit open after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+def retry_hint(error: Exception) -> Optional[float]:
+    """Extract the server-suggested retry delay (seconds) from an API error"""
+    for detail in getattr(error, 'details', None) or []:
+        delay = getattr(detail, 'retry_delay', None)
+        if delay is not None and hasattr(delay, 'seconds'):
+            return delay.seconds + getattr(delay, 'nanos', 0) / 1e9
+    match = re.search(r'retry\D{0,30}?(\d+(?:\.\d+)?)', str(error), re.IGNORECASE)
+    return float(match.group(1)) if match else None
+
+class GeminiClient:
+    """Quota-aware wrapper around Gemini calls with retries and a circuit breaker"""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm, rpm / 60)
+        self.tokens = TokenBucket(tpm, tpm / 60)
+        self.breaker = CircuitBreaker(GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_COOLDOWN)
+        self.cache = OrderedDict()
+        self.cache_size = 256
+
+    def cached(self, key) -> Optional[str]:
+        if key is None or key not in self.cache:
+            return None
+        self.cache.move_to_end(key)
+        return self.cache[key]
+
+    def _remember(self, key, text: str):
+        if key is None:
+            return
+        self.cache[key] = text
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def send(self, call: Callable[[], Awaitable], prompt: str, cache_key=None) -> str:
+        """Run `call` (a Gemini coroutine factory) and return the response text.
+
+        Raises GeminiUnavailableError when the circuit is open or retries are exhausted;
+        other errors (invalid request, blocked content) propagate unchanged.
+        """
+        if not self.breaker.allow():
+            raise GeminiUnavailableError("circuit open")
+
+        estimated = estimate_tokens(prompt) + generation_config['max_output_tokens']
+        last_error = None
+        for attempt in range(GEMINI_MAX_RETRIES):
+            await self.requests.acquire()
+            await self.tokens.acquire(estimated)
+            try:
+                response = await call()
+                text = response.text
+            except RETRYABLE_ERRORS as e:
+                last_error = e
+                self.breaker.record_failure()
+                if not self.breaker.allow() or attempt == GEMINI_MAX_RETRIES - 1:
+                    break
+                backoff = min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt)
+                delay = max(retry_hint(e) or 0, random.uniform(0, backoff))
+                logger.warning(f"Gemini retry {attempt + 1} in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                continue
+            except Exception as e:
+                # Not retryable (invalid request, blocked content, ...); Gemini itself answered
+                logger.error(f"Gemini error: {e}")
+                self.breaker.record_success()
+                raise
+
+            usage = getattr(response, 'usage_metadata', None)
+            if usage and getattr(usage, 'total_token_count', 0):
+                self.tokens.consume(usage.total_token_count - estimated)
+            self.breaker.record_success()
+            self._remember(cache_key, text)
+            return text
+
+        logger.error(f"Gemini unavailable: {last_error}")
+        raise GeminiUnavailableError(str(last_error))
+
+gemini = GeminiClient(GEMINI_RPM, GEMINI_TPM)
+
+# ============================================================================
+# FAIR SCHEDULING
+# ============================================================================
+class FairScheduler:
+    """Limits concurrent expensive jobs and hands free slots to users round-robin.
+
+    Each user also has a token bucket, so a burst of requests from one person is
+    rejected early instead of queueing in front of everybody else.
+    """
+    
+    def __init__(self, workers: int, rate_per_minute: float, burst: int):
+        self.free = workers
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.queues = {}      # user_id -> deque of futures waiting for a slot
+        self.order = deque()  # users with waiting jobs, in round-robin order
+        self.buckets = {}
+    
+    def check_rate(self, user_id: int) -> float:
+        """Charge one request; returns 0 if allowed, else seconds to wait"""
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            if len(self.buckets) > 1000:
+                self._prune_buckets()
+            bucket = self.buckets[user_id] = TokenBucket(self.burst, self.rate)
+        return bucket.try_take()
+    
+    def charge(self, user_id: int, amount: float):
+        """Bill extra LLM calls made on behalf of one request (the bucket may go into debt)"""
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = TokenBucket(self.burst, self.rate)
+        bucket.consume(amount)
+    
+    def _prune_buckets(self):
+        for user_id, bucket in list(self.buckets.items()):
+            bucket._refill()
+            if bucket.tokens >= bucket.capacity:
+                del self.buckets[user_id]
+    
+    def position(self, user_id: int) -> int:
+        """1-based position of the user's newest waiting job under round-robin"""
+        k = len(self.queues.get(user_id, ()))
+        ahead = sum(min(len(q), k) for uid, q in self.queues.items() if uid != user_id)
+        return ahead + k
+    
+    async def run(self, user_id: int, func: Callable[[], Awaitable], on_queued: Callable[[int], Awaitable] = None):
+        if self.free > 0 and not self.order:
+            self.free -= 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            queue = self.queues.setdefault(user_id, deque())
+            if not queue:
+                self.order.append(user_id)
+            queue.append(waiter)
+            if on_queued:
+                try:
+                    await on_queued(self.position(user_id))
+                except Exception as e:
+                    logger.warning(f"Queue notice failed: {e}")
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # A slot was handed to us just before cancellation
+                    self._release()
+                else:
+                    self._forget(user_id, waiter)
+                raise
+        try:
+            return await func()
+        finally:
+            self._release()
+    
+    def _forget(self, user_id: int, waiter):
+        queue = self.queues.get(user_id)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self.queues[user_id]
+                self.order.remove(user_id)
+    
+    def _release(self):
+        while self.order:
+            user_id = self.order.popleft()
+            queue = self.queues[user_id]
+            waiter = queue.popleft()
+            if queue:
+                self.order.append(user_id)
+            else:
+                del self.queues[user_id]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.free += 1
+
+scheduler = FairScheduler(LLM_WORKERS, USER_RATE_PER_MIN, USER_BURST)
+
+# ============================================================================
+# STATE BACKEND
+# ============================================================================
+class MemoryState:
+    """Session history, languages and creator id kept in this process"""
+
+    name = 'memory'
+
+    def __init__(self, max_turns: int, ttl: int):
+        self.max_entries = max_turns * 2
+        self.ttl = ttl
+        self.histories = {}  # user_id -> (expires_at, entries)
+        self.languages = {}
+        self.creator_id = None
+
+    async def get_history(self, user_id: int) -> List[Dict]:
+        item = self.histories.get(user_id)
+        if item is None:
+            return []
+        expires_at, entries = item
+        if expires_at < time.monotonic():
+            del self.histories[user_id]
+            return []
+        return list(entries)
+
+    async def has_history(self, user_id: int) -> bool:
+        return bool(await self.get_history(user_id))
+
+    async def append_history(self, user_id: int, entries: List[Dict]):
+        history = (await self.get_history(user_id) + entries)[-self.max_entries:]
+        self.histories[user_id] = (time.monotonic() + self.ttl, history)
+
+    async def clear_history(self, user_id: int):
+        self.histories.pop(user_id, None)
+
+    async def get_language(self, user_id: int) -> Optional[str]:
+        return self.languages.get(user_id)
+
+    async def set_language(self, user_id: int, lang: str):
+        self.languages[user_id] = lang
+
+    async def get_creator_id(self) -> Optional[int]:
+        return self.creator_id
+
+    async def claim_creator_id(self, user_id: int) -> int:
+        if self.creator_id is None:
+            self.creator_id = user_id
+        return self.creator_id
+
+    async def close(self):
+        pass
+
+class RedisState:
+    """Same state in Redis so several workers see one conversation per user.
+
+    Takes any client with the redis.asyncio API (e.g. fakeredis for local runs).
+    """
+
+    name = 'redis'
+
+    def __init__(self, client, max_turns: int, ttl: int, prefix: str = 'pipila'):
+        self.client = client
+        self.max_entries = max_turns * 2
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, kind: str, user_id: int = None) -> str:
+        return f"{self.prefix}:{kind}" if user_id is None else f"{self.prefix}:{kind}:{user_id}"
+
+    @staticmethod
+    def _text(value) -> Optional[str]:
+        return value.decode() if isinstance(value, bytes) else value
+
+    async def get_history(self, user_id: int) -> List[Dict]:
+        raw = await self.client.lrange(self._key('history', user_id), 0, -1)
+        return [json.loads(item) for item in raw]
+
+    async def has_history(self, user_id: int) -> bool:
+        return bool(await self.client.exists(self._key('history', user_id)))
+
+    async def append_history(self, user_id: int, entries: List[Dict]):
+        key = self._key('history', user_id)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.rpush(key, *[json.dumps(entry, ensure_ascii=False) for entry in entries])
+        pipe.ltrim(key, -self.max_entries, -1)
+        pipe.expire(key, self.ttl)
+        await pipe.execute()
+
+    async def clear_history(self, user_id: int):
+        await self.client.delete(self._key('history', user_id))
+
+    async def get_language(self, user_id: int) -> Optional[str]:
+        return self._text(await self.client.get(self._key('lang', user_id)))
+
+    async def set_language(self, user_id: int, lang: str):
+        await self.client.set(self._key('lang', user_id), lang)
+
+    async def get_creator_id(self) -> Optional[int]:
+        value = self._text(await self.client.get(self._key('creator')))
+        return int(value) if value else None
+
+    async def claim_creator_id(self, user_id: int) -> int:
+        # First worker to see the creator wins; everyone else reads the stored id
+        await self.client.set(self._key('creator'), user_id, nx=True)
+        return await self.get_creator_id()
+
+    async def close(self):
+        await self.client.aclose()
+
+def create_state():
+    if STATE_BACKEND == 'redis':
+        if aioredis is None:
+            logger.error("❌ STATE_BACKEND=redis requires the 'redis' package")
+            sys.exit(1)
+        client = aioredis.from_url(REDIS_URL or 'redis://localhost:6379/0', decode_responses=True)
+        return RedisState(client, SESSION_MAX_TURNS, SESSION_TTL, STATE_PREFIX)
+    return MemoryState(SESSION_MAX_TURNS, SESSION_TTL)
+
+state = create_state()
 
 # ============================================================================
 # CHAT SESSIONS
 # ============================================================================
-chat_sessions = {}
-user_languages = {}
+language_models = {}
 
-def get_chat_session(user_id: int, lang: str = 'es'):
-    if user_id not in chat_sessions:
-        user_model = genai.GenerativeModel(
+def get_language_model(lang: Optional[str] = 'es'):
+    """Model with the persona for `lang`; None gives the plain model"""
+    if lang not in language_models:
+        language_models[lang] = load_genai().GenerativeModel(
             model_name='gemini-2.5-flash',
             generation_config=generation_config,
             safety_settings=safety_settings,
-            system_instruction=SYSTEM_INSTRUCTIONS[lang]
+            system_instruction=SYSTEM_INSTRUCTIONS[lang] if lang else None
         )
-        chat_sessions[user_id] = user_model.start_chat(history=[])
-    return chat_sessions[user_id]
+    return language_models[lang]
+
+async def get_chat_session(user_id: int, lang: str = 'es'):
+    """Rebuild the user's chat from the stored history"""
+    history = await state.get_history(user_id)
+    return get_language_model(lang).start_chat(
+        history=[{'role': entry['role'], 'parts': [entry['text']]} for entry in history]
+    )
 
-def clear_chat_session(user_id: int):
-    if user_id in chat_sessions:
-        del chat_sessions[user_id]
+async def save_exchange(user_id: int, prompt: str, response: str):
+    """Append a question/answer pair to the user's history so follow-ups keep context"""
+    await state.append_history(user_id, [
+        {'role': 'user', 'text': prompt},
+        {'role': 'model', 'text': response},
+    ])
+
+async def has_session_history(user_id: int) -> bool:
+    return await state.has_history(user_id)
 
-def get_user_language(user_id: int) -> str:
-    return user_languages.get(user_id, 'es')
+async def clear_chat_session(user_id: int):
+    await state.clear_history(user_id)
 
-def set_user_language(user_id: int, lang: str):
-    user_languages[user_id] = lang
-    clear_chat_session(user_id)
+async def get_user_language(user_id: int) -> str:
+    lang = await state.get_language(user_id)
+    if lang is None:
+        lang = (await storage.get_user(user_id)).get('language') or 'es'
+        await state.set_language(user_id, lang)
+    return lang
+
+async def set_user_language(user_id: int, lang: str):
+    await state.set_language(user_id, lang)
+    await clear_chat_session(user_id)
 
 # ============================================================================
 # AI RESPONSE
 # ============================================================================
-async def generate_response(query: str, user_id: int = None, context_docs: List[Dict] = None) -> str:
+def normalize_query(query: str) -> str:
+    return ' '.join(query.lower().split())
+
+def build_prompt(query: str, context_docs: List[Dict] = None, budget_tokens: int = RAG_CONTEXT_TOKENS) -> str:
+    if not context_docs:
+        return query
+    context_text = "\n\n".join([
+        f"[{doc['source']}]: {doc['text']}" 
+        for doc in build_context(context_docs, budget_tokens)
+    ])
+    return f"""DOCUMENTOS:\n{context_text}\n\nPREGUNTA: {query}\n\nResponde basándote en los documentos."""
+
+async def generate_response(query: str, user_id: int = None, context_docs: List[Dict] = None,
+                            budget_tokens: int = RAG_CONTEXT_TOKENS) -> str:
     try:
-        lang = get_user_language(user_id) if user_id else 'es'
-        chat = get_chat_session(user_id, lang) if user_id else model_text.start_chat(history=[])
-        
-        if context_docs:
-            context_text = "\n\n".join([
-                f"[{doc['source']}]: {doc['text'][:500]}" 
-                for doc in context_docs
-            ])
-            prompt = f"""DOCUMENTOS:\n{context_text}\n\nPREGUNTA: {query}\n\nResponde basándote en los documentos."""
-        else:
-            prompt = query
-        
-        for attempt in range(3):
-            try:
-                response = chat.send_message(prompt)
-                return response.text
-            except Exception as e:
-                logger.error(f"Gemini error: {e}")
-                await asyncio.sleep(1)
+        lang = await get_user_language(user_id) if user_id else 'es'
+        chat = await get_chat_session(user_id, lang) if user_id else get_language_model(None).start_chat(history=[])
+        # Session answers depend on this user's history and uploads: never serve them to others
+        cache_key = (user_id, normalize_query(query), lang)
+        prompt = build_prompt(query, context_docs, budget_tokens)
         
-        return get_text(lang, 'error', error="AI no disponible")
+        try:
+            response = await gemini.send(lambda: chat.send_message_async(prompt), prompt, cache_key=cache_key)
+        except GeminiUnavailableError:
+            # Degraded mode: reuse a previous answer to the same question if we have one
+            return gemini.cached(cache_key) or get_text(lang, 'ai_unavailable')
+        if user_id:
+            await save_exchange(user_id, prompt, response)
+        return response
         
     except Exception as e:
         logger.error(f"Response error: {e}")
-        lang = get_user_language(user_id) if user_id else 'es'
+        lang = await get_user_language(user_id) if user_id else 'es'
         return get_text(lang, 'error', error=str(e)[:30])
 
-async def process_file(file_bytes: bytes, filename: str, query: str = "", user_id: int = None) -> str:
+# ============================================================================
+# REQUEST COALESCING
+# ============================================================================
+class SingleFlight:
+    """Runs one coroutine per key; concurrent callers with the same key share its result"""
+
+    def __init__(self):
+        self.inflight = {}
+
+    async def do(self, key, func: Callable[[], Awaitable]):
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            logger.info(f"🔗 Coalesced query: {key[0][:40]}")
+        # Shield so a cancelled caller does not cancel the shared work for the others
+        return await asyncio.shield(task)
+
+coalescer = SingleFlight()
+
+async def generate_shared_response(query: str, lang: str):
+    """Retrieval + stateless generation for a (query, language) pair.
+
+    Returns (prompt, response); prompt is None when the answer is degraded.
+    """
+    cache_key = (normalize_query(query), lang)
+    context_docs = await retrieve(query)
+    prompt = build_prompt(query, context_docs)
     try:
-        lang = get_user_language(user_id) if user_id else 'es'
-        file_ext = Path(filename).suffix.lower()
-        
-        temp_path = f"/tmp/{filename}"
-        with open(temp_path, 'wb') as f:
-            f.write(file_bytes)
-        
-        text = ""
-        if file_ext == '.pdf':
-            text = extract_text_from_pdf(temp_path)
-        elif file_ext in ['.docx', '.doc']:
-            text = extract_text_from_docx(temp_path)
-        elif file_ext == '.txt':
-            text = file_bytes.decode('utf-8', errors='ignore')
-        
-        os.remove(temp_path)
+        model = get_language_model(lang)
+        response = await gemini.send(lambda: model.generate_content_async(prompt), prompt, cache_key=cache_key)
+        return prompt, response
+    except GeminiUnavailableError:
+        return None, gemini.cached(cache_key) or get_text(lang, 'ai_unavailable')
+
+async def answer_query(query: str, user_id: int, on_queued: Callable[[int], Awaitable] = None) -> str:
+    """Answer a free-text question, sharing work between identical concurrent questions.
+
+    Only users without session history or uploaded documents are coalesced, since both
+    change the answer. The expensive part runs through the fair scheduler; `on_queued`
+    gets the queue position.
+    """
+    lang = await get_user_language(user_id)
+    if doc_index.active(user_id) or await has_session_history(user_id):
+        async def personal():
+            context_docs, upload_docs = await asyncio.gather(retrieve(query), doc_index.search(user_id, query))
+            if upload_docs:
+                # Questions about an uploaded file get room for its sections on top of the KB
+                return await generate_response(query, user_id=user_id, context_docs=upload_docs + context_docs,
+                                               budget_tokens=RAG_CONTEXT_TOKENS + FILE_CONTEXT_TOKENS)
+            return await generate_response(query, user_id=user_id, context_docs=context_docs)
+        return await scheduler.run(user_id, personal, on_queued)
+    
+    try:
+        prompt, response = await coalescer.do(
+            (normalize_query(query), lang),
+            lambda: scheduler.run(user_id, lambda: generate_shared_response(query, lang), on_queued)
+        )
+    except Exception as e:
+        logger.error(f"Response error: {e}")
+        return get_text(lang, 'error', error=str(e)[:30])
+    if prompt:
+        await save_exchange(user_id, prompt, response)
+    return response
+
+async def process_file(upload: 'UploadEntry', filename: str, query: str = "", user_id: int = None) -> str:
+    try:
+        lang = await get_user_language(user_id) if user_id else 'es'
+        text = upload.text
         
         if not text or len(text) < 10:
             return get_text(lang, 'file_error')
         
-        chat = get_chat_session(user_id, lang)
-        prompt = f"DOCUMENTO: {filename}\n\n{text[:3000]}\n\n{query if query else 'Resume el contenido.'}"
+        question = query if query else 'Resume el contenido.'
+        if len(text) > FILE_DIRECT_CHARS:
+            doc_index.schedule(user_id, filename, upload)
         
-        response = chat.send_message(prompt)
-        return response.text
+        response = upload.answer(user_id, query, lang)
+        if len(text) <= FILE_DIRECT_CHARS:
+            prompt = f"DOCUMENTO: {filename}\n\n{text}\n\n{question}"
+        elif response is not None:
+            # Follow-ups about a long file go through the upload index, not the history
+            prompt = f"DOCUMENTO: {filename}\n\n{question}"
+        
+        if response is None:
+            try:
+                if len(text) > FILE_DIRECT_CHARS:
+                    prompt = await long_document_prompt(upload, filename, query, user_id, lang)
+                chat = await get_chat_session(user_id, lang)
+                response = await gemini.send(lambda: chat.send_message_async(prompt), prompt)
+            except GeminiUnavailableError:
+                return get_text(lang, 'ai_unavailable')
+            upload.remember(user_id, query, lang, response)
+        await save_exchange(user_id, prompt, response)
+        return response
         
     except Exception as e:
         logger.error(f"File error: {e}")
-        lang = get_user_language(user_id) if user_id else 'es'
+        lang = await get_user_language(user_id) if user_id else 'es'
         return get_text(lang, 'file_error')
 
 # ============================================================================
@@ -501,47 +1225,816 @@ async def process_file(file_bytes: bytes, filename: str, query: str = "", user_i
 # ============================================================================
 chroma_client = None
 collection = None
+knowledge = None  # IndexHandle currently serving queries
+knowledge_ready = asyncio.Event()
+index_lock = threading.Lock()
+INDEX_POINTER = CHROMA_PATH + '.current'  # directory of the latest validated build
+INDEX_BUILD_LOCK = CHROMA_PATH + '.lock'  # flock held by the worker building or cleaning up
+INDEX_IN_USE = '.in_use'  # file inside each index dir, share-locked by every worker serving it
+
+class IndexHandle:
+    """An open Chroma directory and the number of searches currently using it"""
+
+    def __init__(self, path: str, client, collection):
+        self.path = path
+        self.client = client
+        self.collection = collection
+        self.active = 0
+        self.retired = False
+        # Held until this worker stops serving the directory, so no worker deletes it meanwhile
+        self.usage_fd = os.open(os.path.join(path, INDEX_IN_USE), os.O_CREAT | os.O_RDWR, 0o644)
+        fcntl.flock(self.usage_fd, fcntl.LOCK_SH)
+
+    def close(self):
+        if self.usage_fd is not None:
+            os.close(self.usage_fd)
+            self.usage_fd = None
+
+def open_index(path: str, create: bool = False) -> IndexHandle:
+    import chromadb
+    client = chromadb.PersistentClient(path=path)
+    if create:
+        coll = client.get_or_create_collection(name="pipila_documents")
+    else:
+        coll = client.get_collection(name="pipila_documents")
+    return IndexHandle(path, client, coll)
 
-try:
-    chroma_client = chromadb.PersistentClient(path=CHROMA_PATH)
-    collection = chroma_client.get_or_create_collection(name="pipila_documents")
-    logger.info(f"✅ ChromaDB: {collection.count()} chunks")
-except Exception as e:
-    logger.warning(f"⚠️ ChromaDB: {e}")
-
-def extract_text_from_pdf(file_path: str) -> str:
+def current_index_path() -> str:
+    try:
+        with open(INDEX_POINTER) as f:
+            path = f.read().strip()
+        if path and os.path.isdir(path):
+            return path
+    except OSError:
+        pass
+    return CHROMA_PATH
+
+def open_knowledge_base():
+    """Import chromadb and open the collection; slow, so startup runs it in the background"""
+    global knowledge, chroma_client, collection
+    try:
+        handle = open_index(current_index_path(), create=True)
+        knowledge, chroma_client, collection = handle, handle.client, handle.collection
+        logger.info(f"✅ ChromaDB: {collection.count()} chunks ({handle.path})")
+    except Exception as e:
+        logger.warning(f"⚠️ ChromaDB: {e}")
+    remove_stale_builds()
+
+def acquire_index() -> Optional[IndexHandle]:
+    with index_lock:
+        handle = knowledge
+        if handle:
+            handle.active += 1
+        return handle
+
+def release_index(handle: IndexHandle):
+    with index_lock:
+        handle.active -= 1
+        done = handle.retired and handle.active == 0
+    if done:
+        handle.close()
+
+def swap_index(new: IndexHandle, publish: bool = True):
+    """Point searches at `new` and, if `publish`, make it the build other workers follow.
+
+    The old directory is released once its last search finishes; remove_stale_builds
+    deletes it when no worker serves it any more.
+    """
+    global knowledge, chroma_client, collection
+    with index_lock:
+        old = knowledge
+        knowledge, chroma_client, collection = new, new.client, new.collection
+        done = False
+        if old:
+            old.retired = True
+            done = old.active == 0
+    if publish:
+        tmp = INDEX_POINTER + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(new.path)
+        os.replace(tmp, INDEX_POINTER)
+    if done:
+        old.close()
+
+def index_in_use(path: str) -> bool:
+    """Whether any worker (this one included) still holds the directory's usage lock"""
+    try:
+        fd = os.open(os.path.join(path, INDEX_IN_USE), os.O_RDWR)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return False
+    except OSError:
+        return True
+    finally:
+        os.close(fd)
+
+def remove_index_dir(path: str):
+    shutil.rmtree(path, ignore_errors=True)
+    logger.info(f"🧹 Removed old index {path}")
+
+def try_lock_builds() -> Optional[int]:
+    """Take the build lock without waiting; None while another worker holds it"""
+    fd = os.open(INDEX_BUILD_LOCK, os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+def unlock_builds(fd: int):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+def remove_stale_builds():
+    """Drop leftovers of interrupted or superseded builds no worker is serving, unless a build is running"""
+    lock = try_lock_builds()
+    if lock is None:
+        logger.debug("Index build in progress, skipping cleanup of old builds")
+        return
     try:
-        with open(file_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
-            return "".join([p.extract_text() for p in reader.pages if p.extract_text()])
+        keep = {os.path.abspath(current_index_path())}
+        if knowledge:
+            keep.add(os.path.abspath(knowledge.path))
+        for path in Path(CHROMA_PATH).parent.glob(Path(CHROMA_PATH).name + '.*'):
+            if path.is_dir() and str(path.resolve()) not in keep and not index_in_use(str(path)):
+                remove_index_dir(str(path))
+    finally:
+        unlock_builds(lock)
+
+retrieval_cache = OrderedDict()  # normalized query -> relevant docs
+
+async def retrieve(query: str) -> List[Dict]:
+    """search_knowledge off the event loop, waiting for the knowledge base if it is still opening"""
+    key = normalize_query(query)
+    if key in retrieval_cache:
+        retrieval_cache.move_to_end(key)
+        return list(retrieval_cache[key])
+    if not knowledge_ready.is_set():
+        try:
+            await asyncio.wait_for(knowledge_ready.wait(), KNOWLEDGE_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("⚠️ Knowledge base still loading, answering without it")
+    docs = await asyncio.to_thread(search_knowledge, query)
+    # Empty results are not cached: they may come from a search error
+    if docs and RETRIEVAL_CACHE_SIZE > 0:
+        retrieval_cache[key] = docs
+        while len(retrieval_cache) > RETRIEVAL_CACHE_SIZE:
+            retrieval_cache.popitem(last=False)
+    return list(docs)
+
+SUPPORTED_UPLOADS = {'.pdf', '.docx', '.doc', '.pptx', '.txt'}
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='upload')
+
+def extract_text_from_pdf(stream: BinaryIO, max_pages: int = UPLOAD_MAX_PAGES) -> str:
+    import PyPDF2
+    try:
+        reader = PyPDF2.PdfReader(stream)
+        if len(reader.pages) > max_pages:
+            logger.info(f"📄 PDF has {len(reader.pages)} pages, reading the first {max_pages}")
+        texts = []
+        for page in reader.pages[:max_pages]:
+            try:
+                text = page.extract_text()
+            except Exception:
+                continue
+            if text:
+                texts.append(text)
+        return "\n".join(texts)
     except:
         return ""
 
-def extract_text_from_docx(file_path: str) -> str:
+def extract_text_from_docx(stream: BinaryIO) -> str:
+    import docx
     try:
-        doc = docx.Document(file_path)
+        doc = docx.Document(stream)
         return "\n".join([p.text for p in doc.paragraphs if p.text])
     except:
         return ""
 
-def search_knowledge(query: str, n_results: int = 5) -> List[Dict]:
-    if not collection:
+def extract_text_from_pptx(stream: BinaryIO, max_slides: int = UPLOAD_MAX_PAGES) -> str:
+    from pptx import Presentation
+    try:
+        prs = Presentation(stream)
+        texts = []
+        for slide in list(prs.slides)[:max_slides]:
+            for shape in slide.shapes:
+                if hasattr(shape, "text") and shape.text:
+                    texts.append(shape.text)
+        return "\n".join(texts)
+    except:
+        return ""
+
+def extract_text(stream: BinaryIO, file_ext: str) -> str:
+    """Parse an uploaded file from a buffer; blocking, run it on upload_executor"""
+    stream.seek(0)
+    if file_ext == '.pdf':
+        return extract_text_from_pdf(stream)
+    elif file_ext in ['.docx', '.doc']:
+        return extract_text_from_docx(stream)
+    elif file_ext == '.pptx':
+        return extract_text_from_pptx(stream)
+    elif file_ext == '.txt':
+        return stream.read(UPLOAD_MAX_BYTES).decode('utf-8', errors='ignore')
+    return ""
+
+def distance_to_similarity(distance: float, space: str = 'l2') -> float:
+    """Map a Chroma distance to a [0, 1] similarity for the collection's metric"""
+    if space == 'l2':
+        # Squared L2 between unit vectors is 2 - 2*cos
+        return max(0.0, 1 - distance / 2)
+    return max(0.0, 1 - distance)
+
+def select_relevant(docs: List[Dict]) -> List[Dict]:
+    """Adaptive k: keep hits above the cutoff and close to the best one"""
+    if not docs:
+        return []
+    top = max(doc['score'] for doc in docs)
+    if top < RAG_MIN_SIMILARITY:
+        return []
+    floor = max(RAG_MIN_SIMILARITY, top - RAG_RELATIVE_MARGIN)
+    return [doc for doc in docs if doc['score'] >= floor][:RAG_MAX_K]
+
+def search_knowledge(query: str, n_results: int = RAG_CANDIDATES) -> List[Dict]:
+    handle = acquire_index()
+    if not handle:
         return []
     try:
-        results = collection.query(query_texts=[query], n_results=n_results)
+        space = (handle.collection.metadata or {}).get('hnsw:space', 'l2')
+        results = handle.collection.query(
+            query_texts=[query],
+            n_results=n_results,
+            include=['documents', 'metadatas', 'distances', 'embeddings']
+        )
         docs = []
         if results and results['documents'] and results['documents'][0]:
+            embeddings = results.get('embeddings')
+            embeddings = embeddings[0] if embeddings is not None and len(embeddings) else None
             for i, doc in enumerate(results['documents'][0]):
                 metadata = results['metadatas'][0][i]
+                distance = results['distances'][0][i]
                 docs.append({
                     'text': doc,
                     'source': metadata.get('source', 'Unknown'),
-                    'chunk': metadata.get('chunk', 0)
+                    'chunk': metadata.get('chunk', 0),
+                    'distance': distance,
+                    'score': distance_to_similarity(distance, space),
+                    'embedding': [float(x) for x in embeddings[i]] if embeddings is not None else None
                 })
-        return docs
+        relevant = select_relevant(docs)
+        if docs and not relevant:
+            logger.info(f"🔍 No relevant context (best {max(d['score'] for d in docs):.2f})")
+        return relevant
     except Exception as e:
         logger.error(f"Search error: {e}")
         return []
+    finally:
+        release_index(handle)
+
+# ============================================================================
+# UPLOAD CACHE
+# ============================================================================
+class UploadEntry:
+    """Extracted text of an uploaded file and the answers already given about it.
+
+    The text is shared by everyone who sends the file; answers are kept per user,
+    since they come from that user's chat session and history.
+    """
+
+    def __init__(self, digest: str, text: str):
+        self.digest = digest
+        self.text = text
+        self.answers = OrderedDict()  # (user_id, normalized caption, lang) -> response
+        self.expires_at = time.monotonic() + UPLOAD_CACHE_TTL
+
+    def answer(self, user_id: int, query: str, lang: str) -> Optional[str]:
+        return self.answers.get((user_id, normalize_query(query), lang))
+
+    def remember(self, user_id: int, query: str, lang: str, response: str):
+        self.answers[(user_id, normalize_query(query), lang)] = response
+        while len(self.answers) > UPLOAD_CACHE_ANSWERS:
+            self.answers.popitem(last=False)
+
+class UploadCache:
+    """Recent uploads by content hash, also reachable by Telegram's file_unique_id.
+
+    The file id is known before downloading, so a forwarded file is answered without
+    touching Telegram; the hash catches the same document uploaded as a new file.
+    """
+
+    def __init__(self, max_files: int):
+        self.max_files = max_files
+        self.entries = OrderedDict()  # sha256 -> UploadEntry
+        self.file_ids = {}  # file_unique_id -> sha256
+
+    def get(self, file_unique_id: str) -> Optional[UploadEntry]:
+        digest = self.file_ids.get(file_unique_id)
+        return self.get_by_digest(digest) if digest else None
+
+    def get_by_digest(self, digest: str) -> Optional[UploadEntry]:
+        entry = self.entries.get(digest)
+        if entry is None:
+            return None
+        if entry.expires_at < time.monotonic():
+            self._drop(digest)
+            return None
+        self.entries.move_to_end(digest)
+        return entry
+
+    def put(self, file_unique_id: str, entry: UploadEntry):
+        self.entries[entry.digest] = entry
+        self.entries.move_to_end(entry.digest)
+        self.file_ids[file_unique_id] = entry.digest
+        while len(self.entries) > self.max_files:
+            self._drop(next(iter(self.entries)))
+
+    def _drop(self, digest: str):
+        self.entries.pop(digest, None)
+        for file_id in [f for f, d in self.file_ids.items() if d == digest]:
+            del self.file_ids[file_id]
+
+upload_cache = UploadCache(UPLOAD_CACHE_FILES)
+
+def hash_stream(stream: BinaryIO) -> str:
+    stream.seek(0)
+    digest = hashlib.sha256()
+    for block in iter(lambda: stream.read(1 << 20), b''):
+        digest.update(block)
+    return digest.hexdigest()
+
+async def load_upload(bot, document) -> UploadEntry:
+    """Text of an uploaded document; downloads and parses only on a cache miss"""
+    entry = upload_cache.get(document.file_unique_id)
+    if entry:
+        return entry
+    
+    file = await bot.get_file(document.file_id)
+    file_ext = Path(document.file_name).suffix.lower()
+    loop = asyncio.get_running_loop()
+    # Small files stay in memory, big ones spill to an anonymous temp file
+    with tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES) as buffer:
+        await file.download_to_memory(out=buffer)
+        digest = await loop.run_in_executor(upload_executor, hash_stream, buffer)
+        entry = upload_cache.get_by_digest(digest)
+        if entry is None:
+            text = await loop.run_in_executor(upload_executor, extract_text, buffer, file_ext)
+            entry = UploadEntry(digest, text)
+    
+    # Failed extractions are not cached so a retry parses again
+    if entry.text and len(entry.text) >= 10:
+        upload_cache.put(document.file_unique_id, entry)
+    return entry
+
+# ============================================================================
+# LONG DOCUMENTS (per-user chunk index, map-reduce summaries)
+# ============================================================================
+def chunk_document(text: str, size: int = UPLOAD_CHUNK_CHARS, overlap: int = UPLOAD_CHUNK_OVERLAP) -> List[str]:
+    """Same windows as download_chromadb.chunk_text, so upload chunks look like KB chunks"""
+    chunks = []
+    start = 0
+    while start < len(text):
+        chunk = text[start:start + size].strip()
+        if len(chunk) > 50:
+            chunks.append(chunk)
+        start += size - overlap
+    return chunks
+
+def split_sections(text: str) -> List[str]:
+    """At most FILE_MAX_SECTIONS pieces, cut at a line break where possible"""
+    size = max(FILE_SECTION_CHARS, -(-len(text) // FILE_MAX_SECTIONS))
+    sections = []
+    start = 0
+    while start < len(text):
+        end = start + size
+        if end < len(text):
+            cut = text.rfind('\n', start + size // 2, end)
+            end = cut if cut > 0 else end
+        sections.append(text[start:end].strip())
+        start = end
+    return [section for section in sections if section]
+
+class UserDocIndex:
+    """In-memory chunk index of each user's recent uploads, dropped after UPLOAD_INDEX_TTL idle.
+
+    One collection per user in an ephemeral Chroma client, embedded with the same default
+    model as the knowledge base so scores are comparable.
+    """
+
+    def __init__(self, ttl: int, max_chunks: int):
+        self.ttl = ttl
+        self.max_chunks = max_chunks
+        self.client = None
+        self.expires = {}  # user_id -> expires_at
+        self.digests = {}  # user_id -> digests already indexed
+        self.pending = {}  # user_id -> indexing task
+        self.lock = threading.Lock()  # digests are also reset from _add on the executor
+
+    def _collection(self, user_id: int):
+        if self.client is None:
+            import chromadb
+            self.client = chromadb.EphemeralClient()
+        return self.client.get_or_create_collection(name=f"uploads_{user_id}", metadata={"hnsw:space": "cosine"})
+
+    def active(self, user_id: int) -> bool:
+        return self.expires.get(user_id, 0) > time.monotonic()
+
+    def schedule(self, user_id: int, filename: str, upload: 'UploadEntry'):
+        """Index an upload in the background; searches wait for it"""
+        self.expires[user_id] = time.monotonic() + self.ttl
+        with self.lock:
+            digests = self.digests.setdefault(user_id, set())
+            if upload.digest in digests:
+                return
+            digests.add(upload.digest)
+        previous = self.pending.get(user_id)
+        
+        async def run():
+            if previous:
+                await asyncio.gather(previous, return_exceptions=True)
+            loop = asyncio.get_running_loop()
+            started = time.perf_counter()
+            try:
+                count = await loop.run_in_executor(upload_executor, self._add, user_id, filename, upload)
+                logger.info(f"📑 Indexed {filename} for {user_id}: {count} chunks in {time.perf_counter() - started:.1f}s")
+            except Exception as e:
+                logger.warning(f"⚠️ Upload index failed for {filename}: {e}")
+                with self.lock:
+                    self.digests.get(user_id, set()).discard(upload.digest)
+        
+        self.pending[user_id] = asyncio.create_task(run())
+
+    def _add(self, user_id: int, filename: str, upload: 'UploadEntry') -> int:
+        chunks = chunk_document(upload.text)[:self.max_chunks]
+        coll = self._collection(user_id)
+        if coll.count() + len(chunks) > self.max_chunks:
+            # Room for the new file: forget the older ones, so sending them again re-indexes them
+            self.client.delete_collection(f"uploads_{user_id}")
+            coll = self._collection(user_id)
+            with self.lock:
+                self.digests[user_id] = {upload.digest}
+        for start in range(0, len(chunks), 500):
+            batch = chunks[start:start + 500]
+            coll.upsert(
+                documents=batch,
+                metadatas=[{'source': filename, 'chunk': start + i} for i in range(len(batch))],
+                ids=[f"{upload.digest[:16]}_{start + i}" for i in range(len(batch))]
+            )
+        return len(chunks)
+
+    def _query(self, user_id: int, query: str, n_results: int) -> List[Dict]:
+        coll = self._collection(user_id)
+        count = coll.count()
+        if count == 0:
+            return []
+        results = coll.query(
+            query_texts=[query], n_results=min(n_results, count),
+            include=['documents', 'metadatas', 'distances', 'embeddings']
+        )
+        docs = []
+        embeddings = results.get('embeddings')
+        embeddings = embeddings[0] if embeddings is not None and len(embeddings) else None
+        for i, text in enumerate(results['documents'][0]):
+            metadata = results['metadatas'][0][i]
+            distance = results['distances'][0][i]
+            docs.append({
+                'text': text,
+                'source': metadata.get('source', 'upload'),
+                'chunk': metadata.get('chunk', 0),
+                'distance': distance,
+                'score': distance_to_similarity(distance, 'cosine'),
+                'embedding': [float(x) for x in embeddings[i]] if embeddings is not None else None
+            })
+        return select_relevant(docs)
+
+    async def search(self, user_id: int, query: str, n_results: int = RAG_CANDIDATES) -> List[Dict]:
+        """Relevant sections of the user's uploads ([] when there are none)"""
+        if not self.active(user_id):
+            return []
+        self.expires[user_id] = time.monotonic() + self.ttl
+        pending = self.pending.get(user_id)
+        if pending and not pending.done():
+            await asyncio.shield(pending)
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(upload_executor, self._query, user_id, query, n_results)
+        except Exception as e:
+            logger.error(f"Upload search error: {e}")
+            return []
+
+    def drop(self, user_id: int):
+        self.expires.pop(user_id, None)
+        with self.lock:
+            self.digests.pop(user_id, None)
+        pending = self.pending.pop(user_id, None)
+        if pending:
+            pending.cancel()
+        if self.client is not None:
+            try:
+                self.client.delete_collection(f"uploads_{user_id}")
+            except Exception:
+                pass
+
+    def expire(self):
+        now = time.monotonic()
+        for user_id in [u for u, expires_at in self.expires.items() if expires_at <= now]:
+            self.drop(user_id)
+
+doc_index = UserDocIndex(UPLOAD_INDEX_TTL, UPLOAD_INDEX_MAX_CHUNKS)
+
+async def summarize_sections(text: str, filename: str, lang: str, user_id: int) -> List[str]:
+    """Map step: summarise the parts of a long document, a few at a time.
+
+    The upload holds a single scheduler slot, so the section calls are capped here
+    and billed to the uploader's bucket instead of draining the shared quota.
+    """
+    sections = split_sections(text)
+    model = get_language_model(lang)
+    limit = asyncio.Semaphore(FILE_SECTION_CONCURRENCY)
+    scheduler.charge(user_id, len(sections))
+    
+    async def summarize(number: int, section: str) -> str:
+        prompt = (f"DOCUMENTO: {filename} (parte {number}/{len(sections)})\n\n{section}\n\n"
+                  f"Resume los puntos clave de esta parte: datos, condiciones, importes y plazos.")
+        async with limit:
+            return await gemini.send(lambda: model.generate_content_async(prompt), prompt)
+    
+    return await asyncio.gather(*(summarize(i + 1, section) for i, section in enumerate(sections)))
+
+async def long_document_prompt(upload: 'UploadEntry', filename: str, query: str, user_id: int, lang: str) -> str:
+    """Prompt for a file too long to send whole.
+
+    Questions get the most relevant sections from the user's upload index; summaries
+    (or questions the index can't serve) get the reduce step over per-section summaries.
+    """
+    if query:
+        sections = await doc_index.search(user_id, query)
+        if sections:
+            context = "\n\n".join(f"[{doc['source']}]: {doc['text']}"
+                                   for doc in build_context(sections, FILE_CONTEXT_TOKENS))
+            return f"DOCUMENTO: {filename}\n\nSECCIONES RELEVANTES:\n{context}\n\n{query}"
+    
+    started = time.perf_counter()
+    partials = await summarize_sections(upload.text, filename, lang, user_id)
+    logger.info(f"📚 {filename}: {len(partials)} sections summarised in {time.perf_counter() - started:.1f}s")
+    summaries = "\n\n".join(f"[Parte {i + 1}] {summary}" for i, summary in enumerate(partials))
+    return f"DOCUMENTO: {filename}\n\nRESÚMENES POR PARTES:\n{summaries}\n\n{query if query else 'Resume el contenido.'}"
+
+async def expire_upload_indexes_job(context: ContextTypes.DEFAULT_TYPE):
+    doc_index.expire()
+
+# ============================================================================
+# KNOWLEDGE BASE REBUILD
+# ============================================================================
+reindex_task = None
+index_build_process = None
+
+def validate_index(handle: IndexHandle, previous_count: int) -> int:
+    """Reject empty or suspiciously small builds, and check the index answers a query"""
+    count = handle.collection.count()
+    if count == 0:
+        raise ValueError("new index is empty")
+    if count < previous_count * INDEX_MIN_RATIO:
+        raise ValueError(f"new index has {count} chunks, current has {previous_count}")
+    results = handle.collection.query(query_texts=["DVAG"], n_results=1)
+    if not results['documents'] or not results['documents'][0]:
+        raise ValueError("new index returned no results")
+    return count
+
+async def build_index() -> IndexHandle:
+    """Run the builder into a new directory and open the result (build lock held)"""
+    global index_build_process
+    target = f"{CHROMA_PATH}.{datetime.now():%Y%m%d%H%M%S}"
+    logger.info(f"🔧 Building knowledge base into {target}")
+    index_build_process = await asyncio.create_subprocess_exec(
+        sys.executable, INDEX_BUILDER, '--output', target,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+    )
+    try:
+        async for line in index_build_process.stdout:
+            logger.info(f"🔧 {line.decode(errors='replace').rstrip()}")
+        returncode = await index_build_process.wait()
+    finally:
+        index_build_process = None
+    
+    try:
+        if returncode != 0:
+            raise RuntimeError(f"builder exited with {returncode}")
+        return await asyncio.to_thread(open_index, target)
+    except Exception:
+        await asyncio.to_thread(shutil.rmtree, target, True)
+        raise
+
+async def wait_for_other_build() -> IndexHandle:
+    """Another worker holds the build lock: wait for it and open the index it produced"""
+    logger.info("🔧 Another worker is building the knowledge base, waiting for it")
+    while True:
+        await asyncio.sleep(5)
+        lock = try_lock_builds()
+        if lock is not None:
+            break
+    try:
+        path = current_index_path()
+        if knowledge and os.path.abspath(path) == os.path.abspath(knowledge.path):
+            raise RuntimeError("the other build did not produce a new index")
+        return await asyncio.to_thread(open_index, path)
+    finally:
+        unlock_builds(lock)
+
+async def rebuild_index() -> int:
+    """Build a fresh index in a subprocess and swap it in; returns the new chunk count.
+
+    The bot keeps answering from the current index while the build runs. Only one
+    worker builds at a time (INDEX_BUILD_LOCK); the others pick up its result.
+    """
+    started = time.perf_counter()
+    lock = try_lock_builds()
+    if lock is None:
+        handle = await wait_for_other_build()
+    else:
+        try:
+            handle = await build_index()
+        except Exception:
+            unlock_builds(lock)
+            raise
+    try:
+        previous = collection.count() if collection else 0
+        try:
+            count = await asyncio.to_thread(validate_index, handle, previous)
+        except Exception:
+            handle.close()
+            if lock is not None:
+                await asyncio.to_thread(shutil.rmtree, handle.path, True)
+            raise
+        # Still under the lock, so no other worker reads the pointer half-updated;
+        # a build made by another worker is already published
+        swap_index(handle, publish=lock is not None)
+    finally:
+        if lock is not None:
+            unlock_builds(lock)
+    retrieval_cache.clear()
+    logger.info(f"✅ Knowledge base swapped: {count} chunks in {time.perf_counter() - started:.0f}s")
+    await warm_up()
+    return count
+
+async def follow_index_job(context: ContextTypes.DEFAULT_TYPE):
+    """Switch to a build another worker published, and delete builds no worker serves any more"""
+    if knowledge is None or (reindex_task and not reindex_task.done()):
+        return
+    path = current_index_path()
+    if os.path.abspath(path) != os.path.abspath(knowledge.path):
+        try:
+            handle = await asyncio.to_thread(open_index, path)
+        except Exception as e:
+            logger.warning(f"⚠️ Could not open new index {path}: {e}")
+            return
+        swap_index(handle, publish=False)
+        retrieval_cache.clear()
+        logger.info(f"✅ Knowledge base switched to {path} ({handle.collection.count()} chunks)")
+        await warm_up()
+    await asyncio.to_thread(remove_stale_builds)
+
+def start_reindex(on_done: Callable[[Optional[int], Optional[Exception]], Awaitable] = None) -> bool:
+    """Start a background rebuild unless one is running; `on_done` gets (count, error)"""
+    global reindex_task
+    if reindex_task and not reindex_task.done():
+        return False
+    
+    async def run():
+        try:
+            count = await rebuild_index()
+        except Exception as e:
+            logger.error(f"❌ Reindex failed: {e}")
+            if on_done:
+                await on_done(None, e)
+            return
+        if on_done:
+            await on_done(count, None)
+    
+    reindex_task = asyncio.create_task(run())
+    return True
+
+# ============================================================================
+# CONTEXT BUILDER
+# ============================================================================
+SENTENCE_END = re.compile(r'[.!?…](?:["\')\]]*)\s|\n')
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = (sum(x * x for x in a) ** 0.5) * (sum(y * y for y in b) ** 0.5)
+    return dot / norm if norm else 0.0
+
+def _lexical_similarity(a: str, b: str) -> float:
+    words_a, words_b = set(a.lower().split()), set(b.lower().split())
+    if not words_a or not words_b:
+        return 0.0
+    return len(words_a & words_b) / len(words_a | words_b)
+
+def doc_similarity(a: Dict, b: Dict) -> float:
+    if a.get('embedding') and b.get('embedding'):
+        return _cosine(a['embedding'], b['embedding'])
+    return _lexical_similarity(a['text'], b['text'])
+
+def mmr_select(docs: List[Dict], lambda_mult: float = RAG_MMR_LAMBDA, redundancy: float = 0.95) -> List[Dict]:
+    """Order docs by Maximal Marginal Relevance, dropping near-duplicates"""
+    # Relevance: retrieval score when available, otherwise rank position
+    relevance = [doc.get('score', 1 - i / len(docs)) for i, doc in enumerate(docs)]
+    remaining = list(range(len(docs)))
+    selected = []
+    while remaining:
+        best, best_score = None, None
+        for i in remaining:
+            max_sim = max((doc_similarity(docs[i], docs[j]) for j in selected), default=0.0)
+            if max_sim >= redundancy:
+                continue
+            score = lambda_mult * relevance[i] - (1 - lambda_mult) * max_sim
+            if best_score is None or score > best_score:
+                best, best_score = i, score
+        if best is None:
+            break
+        selected.append(best)
+        remaining.remove(best)
+    return [docs[i] for i in selected]
+
+def _join_overlapping(first: str, second: str, max_overlap: int = 400) -> str:
+    """Concatenate consecutive chunks, removing the overlap the indexer adds"""
+    for k in range(min(max_overlap, len(first), len(second)), 19, -1):
+        if first.endswith(second[:k]):
+            return first + second[k:]
+    return first + " " + second
+
+def merge_adjacent(docs: List[Dict]) -> List[Dict]:
+    """Merge consecutive chunks of the same source, keeping the best rank of the group"""
+    merged = []
+    by_key = {}
+    for doc in docs:
+        prev = by_key.get((doc['source'], doc['chunk'] - 1))
+        nxt = by_key.get((doc['source'], doc['chunk'] + 1))
+        if prev is not None:
+            prev['text'] = _join_overlapping(prev['text'], doc['text'])
+            prev['last_chunk'] = doc['chunk']
+            by_key[(doc['source'], doc['chunk'])] = prev
+            if nxt is not None and nxt is not prev:
+                # This chunk bridges two groups: fold the later one in
+                prev['text'] = _join_overlapping(prev['text'], nxt['text'])
+                prev['last_chunk'] = nxt['last_chunk']
+                for chunk in range(nxt['first_chunk'], nxt['last_chunk'] + 1):
+                    by_key[(doc['source'], chunk)] = prev
+                merged.remove(nxt)
+        elif nxt is not None:
+            nxt['text'] = _join_overlapping(doc['text'], nxt['text'])
+            nxt['first_chunk'] = doc['chunk']
+            by_key[(doc['source'], doc['chunk'])] = nxt
+        else:
+            entry = {
+                'source': doc['source'], 'text': doc['text'],
+                'first_chunk': doc['chunk'], 'last_chunk': doc['chunk']
+            }
+            merged.append(entry)
+            by_key[(doc['source'], doc['chunk'])] = entry
+    return merged
+
+def trim_to_sentence(text: str, max_chars: int) -> str:
+    """Cut text to max_chars, preferring the last sentence boundary"""
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    ends = [m.end() for m in SENTENCE_END.finditer(cut)]
+    if ends and ends[-1] > max_chars // 2:
+        return cut[:ends[-1]].rstrip()
+    space = cut.rfind(' ')
+    return (cut[:space] if space > 0 else cut).rstrip() + "…"
+
+def _drop_leading_fragment(text: str) -> str:
+    """Chunks are cut by length, so a non-initial chunk usually starts mid-sentence"""
+    match = SENTENCE_END.search(text)
+    if match and match.end() < len(text) // 5:
+        return text[match.end():].lstrip()
+    return text
+
+def build_context(docs: List[Dict], budget_tokens: int = RAG_CONTEXT_TOKENS) -> List[Dict]:
+    """Pick diverse passages and pack them into a token budget"""
+    if not docs:
+        return []
+    passages = merge_adjacent(mmr_select(docs))
+    packed = []
+    remaining = budget_tokens
+    for passage in passages:
+        text = passage['text']
+        if passage['first_chunk'] > 0:
+            text = _drop_leading_fragment(text)
+        tokens = estimate_tokens(text)
+        if tokens > remaining:
+            if remaining < 50:
+                break
+            text = trim_to_sentence(text, remaining * 4)
+            tokens = estimate_tokens(text)
+        packed.append({'source': passage['source'], 'text': text})
+        remaining -= tokens
+        if remaining <= 0:
+            break
+    return packed
 
 # ============================================================================
 # DATABASE
@@ -566,16 +2059,214 @@ class Query(Base):
     query = Column(Text)
     response = Column(Text)
     timestamp = Column(DateTime, default=datetime.now)
+    
+    __table_args__ = (
+        Index('ix_queries_user_timestamp', 'user_id', 'timestamp'),
+        Index('ix_queries_timestamp', 'timestamp'),
+    )
+
+class DailyStat(Base):
+    """Per-day query volume, rebuilt from `queries` by refresh_daily_stats"""
+    __tablename__ = 'daily_stats'
+    day = Column(Date, primary_key=True)
+    queries = Column(Integer, default=0)
+    active_users = Column(Integer, default=0)
+
+# Case-insensitive username lookups (/admin add @user)
+Index('ix_users_username_lower', func.lower(User.username))
+Index('ix_users_team_count', User.is_team, User.query_count)
+
+# Aggregate statements shared by the sync and async storage backends
+def team_summary_stmt():
+    return select(
+        func.count(User.id),
+        func.coalesce(func.sum(User.query_count), 0)
+    ).where(User.is_team.is_(True))
+
+def top_users_stmt(limit: int):
+    return (
+        select(User.id, User.first_name, User.username, User.query_count)
+        .where(User.is_team.is_(True))
+        .order_by(User.query_count.desc(), User.id)
+        .limit(limit)
+    )
+
+def team_page_stmt(offset: int, limit: int):
+    return (
+        select(User.id, User.first_name, User.username, User.query_count)
+        .where(User.is_team.is_(True))
+        .order_by(User.id)
+        .offset(offset)
+        .limit(limit)
+    )
+
+def daily_volume_stmt(since: datetime):
+    return select(DailyStat.day, DailyStat.queries, DailyStat.active_users) \
+        .where(DailyStat.day >= since.date()).order_by(DailyStat.day)
+
+def refresh_daily_stmts(since: datetime):
+    """Delete + re-aggregate the summary rows from `since` onwards"""
+    day = func.date(Query.timestamp)
+    aggregate = (
+        select(day, func.count(Query.id), func.count(func.distinct(Query.user_id)))
+        .where(Query.timestamp >= since)
+        .group_by(day)
+    )
+    return (
+        delete(DailyStat).where(DailyStat.day >= since.date()),
+        insert(DailyStat).from_select(['day', 'queries', 'active_users'], aggregate),
+    )
+
+def export_stmt(since: datetime = None, until: datetime = None, user_id: int = None):
+    stmt = select(Query.id, Query.user_id, Query.timestamp, Query.query, Query.response).order_by(Query.id)
+    if since:
+        stmt = stmt.where(Query.timestamp >= since)
+    if until:
+        stmt = stmt.where(Query.timestamp < until)
+    if user_id:
+        stmt = stmt.where(Query.user_id == user_id)
+    return stmt
+
+def export_row(row) -> Dict:
+    return {
+        'id': row[0], 'user_id': row[1],
+        'timestamp': row[2].isoformat() if row[2] else None,
+        'query': row[3], 'response': row[4]
+    }
+
+def member_row(row) -> Dict:
+    return {'id': row[0], 'first_name': row[1] or 'N/A', 'username': row[2] or 'N/A', 'query_count': row[3] or 0}
+
+def ensure_schema(connection):
+    """Create missing tables and indexes.
+
+    create_all only adds indexes together with a new table, so indexes introduced
+    after the tables already exist are created here explicitly.
+    """
+    Base.metadata.create_all(connection)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            # Reflection can't see expression indexes, so let the database check
+            connection.execute(CreateIndex(index, if_not_exists=True))
+
+def async_database_url(url: str) -> str:
+    """Rewrite a sync database URL to the matching asyncio driver"""
+    scheme, rest = url.split('://', 1)
+    if scheme in ('postgres', 'postgresql', 'postgresql+psycopg2'):
+        # asyncpg spells libpq's sslmode as ssl
+        return 'postgresql+asyncpg://' + rest.replace('sslmode=', 'ssl=')
+    if scheme == 'sqlite':
+        return 'sqlite+aiosqlite://' + rest
+    return url
+
+def pool_options(url: str) -> Dict:
+    if url.startswith('sqlite'):
+        return {}
+    return {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+    }
 
 engine = None
 Session = None
+async_engine = None
+AsyncSessionLocal = None
+
+if DATABASE_URL and DB_BACKEND == 'async':
+    try:
+        url = async_database_url(DATABASE_URL)
+        async_engine = create_async_engine(url, echo=False, pool_pre_ping=True, **pool_options(url))
+        AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+        logger.info(f"✅ Database configured (async, {async_engine.dialect.name})")
+    except Exception as e:
+        logger.warning(f"⚠️ Async database unavailable, using sync driver: {e}")
+        async_engine = None
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+def create_sqlite_engine(path: str):
+    """Embedded offline store: WAL journal, relaxed fsync, cached prepared statements"""
+    url = f"sqlite:///{path}" if path != ':memory:' else "sqlite://"
+    options = {'poolclass': StaticPool} if path == ':memory:' else {}
+    sqlite_engine = create_engine(
+        url, echo=False,
+        connect_args={'check_same_thread': False, 'timeout': 30, 'cached_statements': 256},
+        **options
+    )
+    event.listen(sqlite_engine, "connect", _sqlite_pragmas)
+    return sqlite_engine
+
+def create_async_sqlite_engine(path: str):
+    """Same embedded store through aiosqlite, for the async backend's fallback"""
+    url = f"sqlite+aiosqlite:///{path}" if path != ':memory:' else "sqlite+aiosqlite://"
+    options = {'poolclass': StaticPool} if path == ':memory:' else {}
+    sqlite_engine = create_async_engine(url, echo=False, connect_args={'timeout': 30}, **options)
+    event.listen(sqlite_engine.sync_engine, "connect", _sqlite_pragmas)
+    return sqlite_engine
+
+def migrate_json_users(users_file: str = USERS_JSON_PATH):
+    """One-shot import of the legacy users.json store into the database"""
+    if not os.path.exists(users_file):
+        return
+    try:
+        with open(users_file, 'r') as f:
+            data = json.load(f)
+        session = Session()
+        try:
+            for uid, u in data.items():
+                session.merge(User(
+                    id=int(uid),
+                    username=u.get('username', ''),
+                    first_name=u.get('first_name', ''),
+                    is_team=u.get('is_team', False),
+                    language=u.get('language', 'es'),
+                    query_count=u.get('query_count', 0)
+                ))
+            session.commit()
+        finally:
+            session.close()
+        os.replace(users_file, users_file + '.migrated')
+        logger.info(f"✅ Migrated {len(data)} users from {users_file}")
+    except Exception as e:
+        logger.warning(f"⚠️ users.json migration failed: {e}")
 
-if DATABASE_URL:
+def open_sync_database():
+    """Create the schema on the sync engine, falling back to SQLite when the server is unreachable"""
+    global engine, Session
+    if engine is not None:
+        try:
+            with engine.begin() as conn:
+                ensure_schema(conn)
+            logger.info("✅ PostgreSQL connected")
+            return
+        except Exception as e:
+            logger.warning(f"⚠️ Database: {e}")
+    
+    for path in (SQLITE_PATH, ':memory:'):
+        try:
+            engine = create_sqlite_engine(path)
+            with engine.begin() as conn:
+                ensure_schema(conn)
+            Session = sessionmaker(bind=engine)
+            logger.info(f"✅ SQLite store: {path}")
+            break
+        except Exception as e:
+            logger.warning(f"⚠️ SQLite ({path}): {e}")
+            engine = None
+    migrate_json_users()
+
+# Engines connect lazily; the schema is created by storage.init() at startup
+if DATABASE_URL and not async_engine:
     try:
-        engine = create_engine(DATABASE_URL, echo=False, pool_pre_ping=True)
-        Base.metadata.create_all(engine)
+        engine = create_engine(DATABASE_URL, echo=False, pool_pre_ping=True, **pool_options(DATABASE_URL))
         Session = sessionmaker(bind=engine)
-        logger.info("✅ PostgreSQL connected")
     except Exception as e:
         logger.warning(f"⚠️ Database: {e}")
         engine = None
@@ -583,42 +2274,278 @@ if DATABASE_URL:
 # ============================================================================
 # DATA STORAGE
 # ============================================================================
-class DataStorage:
+class UserCacheMixin:
+    """Write-through cache of user rows: user_id -> (expires_at, data)"""
+    
+    def _cache_get(self, user_id: int) -> Optional[Dict]:
+        entry = self.user_cache.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        self.user_cache.pop(user_id, None)
+        return None
+    
+    def _cache_put(self, user_id: int, data: Dict):
+        self.user_cache[user_id] = (time.monotonic() + USER_CACHE_TTL, data)
+    
+    def _cache_patch(self, user_id: int, data: Dict):
+        cached = self._cache_get(user_id)
+        if cached is not None:
+            cached.update({k: v for k, v in data.items() if k in cached})
+    
+    def invalidate_user(self, user_id: int):
+        self.user_cache.pop(user_id, None)
+    
+    def adjust_cached_count(self, user_id: int, delta: int):
+        cached = self._cache_get(user_id)
+        if cached is not None:
+            cached['query_count'] = cached.get('query_count', 0) + delta
+
+class DataStorage(UserCacheMixin):
     def __init__(self):
-        self.users_file = 'users.json'
-        self.users = {} if engine else self._load_users()
+        self.user_cache = {}
+        self.backend_name = engine.dialect.name if engine else 'sqlite'
+        self.persists_queries = True
+    
+    def init(self):
+        open_sync_database()
+        self.backend_name = engine.dialect.name
     
-    def _load_users(self) -> Dict:
+    def get_user(self, user_id: int) -> Dict:
+        cached = self._cache_get(user_id)
+        if cached is not None:
+            return dict(cached)
+        session = Session()
         try:
-            if os.path.exists(self.users_file):
-                with open(self.users_file, 'r') as f:
-                    data = json.load(f)
-                    return {int(k): v for k, v in data.items()}
-            return {}
+            user = session.query(User).filter_by(id=user_id).first()
+            if not user:
+                user = User(id=user_id)
+                session.add(user)
+                session.commit()
+                session.refresh(user)
+            data = {
+                'id': user.id,
+                'username': user.username or '',
+                'first_name': user.first_name or '',
+                'is_team': user.is_team,
+                'language': user.language or 'es',
+                'query_count': user.query_count or 0
+            }
+            self._cache_put(user_id, data)
+            return dict(data)
         except:
-            return {}
+            session.rollback()
+            return {'id': user_id, 'is_team': False, 'language': 'es', 'query_count': 0}
+        finally:
+            session.close()
     
-    def _save_users(self):
-        if not engine:
-            try:
-                with open(self.users_file, 'w') as f:
-                    json.dump(self.users, f, indent=2)
-            except:
-                pass
+    def update_user(self, user_id: int, data: Dict):
+        session = Session()
+        try:
+            user = session.query(User).filter_by(id=user_id).first()
+            if not user:
+                user = User(id=user_id)
+                session.add(user)
+            for key, value in data.items():
+                setattr(user, key, value)
+            user.last_active = datetime.now()
+            session.commit()
+            self._cache_patch(user_id, data)
+        except:
+            session.rollback()
+            self.invalidate_user(user_id)
+        finally:
+            session.close()
     
-    def get_user(self, user_id: int) -> Dict:
-        if engine:
+    def is_team_member(self, user_id: int) -> bool:
+        if user_id == CREATOR_ID:
+            return True
+        return self.get_user(user_id).get('is_team', False)
+    
+    def increment_usage(self, deltas: Dict[int, int], session=None):
+        """Atomically add per-user query counts and touch last_active.
+
+        Issues a single UPDATE ... SET query_count = query_count + CASE id ... for all
+        users, so concurrent increments are never lost. Pass `session` to join an
+        existing transaction; otherwise the update is committed here.
+        """
+        if not deltas:
+            return
+        own_session = session is None
+        session = session or Session()
+        try:
+            now = datetime.now()
+            result = session.execute(
+                update(User)
+                .where(User.id.in_(list(deltas)))
+                .values(
+                    query_count=func.coalesce(User.query_count, 0) + case(deltas, value=User.id, else_=0),
+                    last_active=now
+                )
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount < len(deltas):
+                existing = {row[0] for row in session.query(User.id).filter(User.id.in_(list(deltas)))}
+                session.add_all([
+                    User(id=user_id, query_count=delta, last_active=now)
+                    for user_id, delta in deltas.items() if user_id not in existing
+                ])
+            if own_session:
+                session.commit()
+        except:
+            if own_session:
+                session.rollback()
+            raise
+        finally:
+            if own_session:
+                session.close()
+    
+    def write_usage_batch(self, rows: List[Dict], deltas: Dict[int, int]):
+        """Bulk-insert query rows and apply counter deltas in one transaction"""
+        session = Session()
+        try:
+            if rows:
+                session.execute(insert(Query), rows)
+            self.increment_usage(deltas, session=session)
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+    
+    def prune_queries(self, cutoff: datetime) -> int:
+        """Delete queries older than cutoff in small batches to keep locks short"""
+        removed = 0
+        while True:
             session = Session()
             try:
-                user = session.query(User).filter_by(id=user_id).first()
-                if not user:
-                    user = User(id=user_id)
-                    session.add(user)
-                    session.commit()
-                    session.refresh(user)
-                if user.language:
-                    user_languages[user_id] = user.language
-                return {
+                batch = select(Query.id).where(Query.timestamp < cutoff).limit(QUERY_PRUNE_BATCH)
+                result = session.execute(delete(Query).where(Query.id.in_(batch)))
+                session.commit()
+            except:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+            removed += result.rowcount
+            if result.rowcount < QUERY_PRUNE_BATCH:
+                return removed
+    
+    def get_team_summary(self) -> Dict:
+        session = Session()
+        try:
+            members, total = session.execute(team_summary_stmt()).one()
+            return {'members': members, 'total_queries': total, 'average': total / members if members else 0.0}
+        finally:
+            session.close()
+    
+    def get_top_users(self, limit: int = 5) -> List[Dict]:
+        session = Session()
+        try:
+            return [member_row(r) for r in session.execute(top_users_stmt(limit))]
+        finally:
+            session.close()
+    
+    def get_team_page(self, page: int, page_size: int = TEAM_PAGE_SIZE) -> List[Dict]:
+        session = Session()
+        try:
+            return [member_row(r) for r in session.execute(team_page_stmt(page * page_size, page_size))]
+        finally:
+            session.close()
+    
+    def get_daily_volume(self, days: int = 7) -> List[Dict]:
+        session = Session()
+        try:
+            since = datetime.now() - timedelta(days=days - 1)
+            return [{'day': r[0], 'queries': r[1], 'active_users': r[2]}
+                    for r in session.execute(daily_volume_stmt(since))]
+        finally:
+            session.close()
+    
+    def refresh_daily_stats(self, days: int = 2):
+        since = datetime.combine((datetime.now() - timedelta(days=days - 1)).date(), datetime.min.time())
+        session = Session()
+        try:
+            for stmt in refresh_daily_stmts(since):
+                session.execute(stmt)
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+    
+    def iter_queries(self, since: datetime = None, until: datetime = None, user_id: int = None,
+                     chunk_size: int = EXPORT_CHUNK_SIZE):
+        """Yield lists of query rows using a server-side cursor"""
+        session = Session()
+        try:
+            result = session.execute(
+                export_stmt(since, until, user_id).execution_options(stream_results=True, yield_per=chunk_size)
+            )
+            for partition in result.partitions(chunk_size):
+                yield [export_row(r) for r in partition]
+        finally:
+            session.close()
+    
+    def find_user_by_username(self, username: str) -> Optional[int]:
+        session = Session()
+        try:
+            user = session.query(User).filter(func.lower(User.username) == username.lower()).first()
+            return user.id if user else None
+        except:
+            return None
+        finally:
+            session.close()
+
+class AsyncDataStorage(UserCacheMixin):
+    """DataStorage interface on SQLAlchemy asyncio; every method is a coroutine"""
+    
+    def __init__(self):
+        self.user_cache = {}
+        self.backend_name = async_engine.dialect.name
+        self.persists_queries = True
+    
+    async def init(self):
+        """Create the schema, falling back to SQLite (like the sync path) when the server is unreachable"""
+        global async_engine, AsyncSessionLocal
+        try:
+            async with async_engine.begin() as conn:
+                await conn.run_sync(ensure_schema)
+            logger.info(f"✅ Database ready ({self.backend_name})")
+            return
+        except Exception as e:
+            logger.warning(f"⚠️ Database: {e}")
+            await async_engine.dispose()
+        
+        for path in (SQLITE_PATH, ':memory:'):
+            try:
+                async_engine = create_async_sqlite_engine(path)
+                async with async_engine.begin() as conn:
+                    await conn.run_sync(ensure_schema)
+                AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+                self.backend_name = async_engine.dialect.name
+                logger.info(f"✅ SQLite store: {path}")
+                return
+            except Exception as e:
+                logger.warning(f"⚠️ SQLite ({path}): {e}")
+                await async_engine.dispose()
+        # Keep serving: user lookups fall back to defaults and the query log stays buffered
+        logger.error("❌ No database available")
+    
+    async def get_user(self, user_id: int) -> Dict:
+        cached = self._cache_get(user_id)
+        if cached is not None:
+            return dict(cached)
+        async with AsyncSessionLocal() as session:
+            try:
+                user = await session.get(User, user_id)
+                if not user:
+                    user = User(id=user_id)
+                    session.add(user)
+                    await session.commit()
+                    await session.refresh(user)
+                data = {
                     'id': user.id,
                     'username': user.username or '',
                     'first_name': user.first_name or '',
@@ -626,135 +2553,334 @@ class DataStorage:
                     'language': user.language or 'es',
                     'query_count': user.query_count or 0
                 }
-            except:
-                session.rollback()
+                self._cache_put(user_id, data)
+                return dict(data)
+            except Exception as e:
+                logger.error(f"DB get_user error: {e}")
+                await session.rollback()
                 return {'id': user_id, 'is_team': False, 'language': 'es', 'query_count': 0}
-            finally:
-                session.close()
-        else:
-            if user_id not in self.users:
-                self.users[user_id] = {
-                    'id': user_id, 'username': '', 'first_name': '',
-                    'is_team': False, 'language': 'es', 'query_count': 0
-                }
-                self._save_users()
-            return self.users[user_id]
     
-    def update_user(self, user_id: int, data: Dict):
-        if engine:
-            session = Session()
+    async def update_user(self, user_id: int, data: Dict):
+        async with AsyncSessionLocal() as session:
             try:
-                user = session.query(User).filter_by(id=user_id).first()
+                user = await session.get(User, user_id)
                 if not user:
                     user = User(id=user_id)
                     session.add(user)
                 for key, value in data.items():
                     setattr(user, key, value)
                 user.last_active = datetime.now()
-                session.commit()
-                if 'language' in data:
-                    user_languages[user_id] = data['language']
-            except:
-                session.rollback()
-            finally:
-                session.close()
-        else:
-            user = self.get_user(user_id)
-            user.update(data)
-            if 'language' in data:
-                user_languages[user_id] = data['language']
-            self._save_users()
+                await session.commit()
+                self._cache_patch(user_id, data)
+            except Exception as e:
+                logger.error(f"DB update_user error: {e}")
+                await session.rollback()
+                self.invalidate_user(user_id)
     
-    def is_team_member(self, user_id: int) -> bool:
+    async def is_team_member(self, user_id: int) -> bool:
         if user_id == CREATOR_ID:
             return True
-        return self.get_user(user_id).get('is_team', False)
+        return (await self.get_user(user_id)).get('is_team', False)
     
-    def save_query(self, user_id: int, query: str, response: str):
-        if not engine:
+    async def increment_usage(self, deltas: Dict[int, int], session=None):
+        """Atomic counter update; see DataStorage.increment_usage"""
+        if not deltas:
             return
-        session = Session()
+        if session is None:
+            async with AsyncSessionLocal() as session:
+                await self.increment_usage(deltas, session=session)
+                await session.commit()
+            return
+        now = datetime.now()
+        result = await session.execute(
+            update(User)
+            .where(User.id.in_(list(deltas)))
+            .values(
+                query_count=func.coalesce(User.query_count, 0) + case(deltas, value=User.id, else_=0),
+                last_active=now
+            )
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount < len(deltas):
+            existing = set((await session.execute(select(User.id).where(User.id.in_(list(deltas))))).scalars())
+            session.add_all([
+                User(id=user_id, query_count=delta, last_active=now)
+                for user_id, delta in deltas.items() if user_id not in existing
+            ])
+    
+    async def write_usage_batch(self, rows: List[Dict], deltas: Dict[int, int]):
+        async with AsyncSessionLocal() as session:
+            if rows:
+                await session.execute(insert(Query), rows)
+            await self.increment_usage(deltas, session=session)
+            await session.commit()
+    
+    async def prune_queries(self, cutoff: datetime) -> int:
+        removed = 0
+        while True:
+            async with AsyncSessionLocal() as session:
+                batch = select(Query.id).where(Query.timestamp < cutoff).limit(QUERY_PRUNE_BATCH)
+                result = await session.execute(delete(Query).where(Query.id.in_(batch)))
+                await session.commit()
+            removed += result.rowcount
+            if result.rowcount < QUERY_PRUNE_BATCH:
+                return removed
+    
+    async def get_team_summary(self) -> Dict:
+        async with AsyncSessionLocal() as session:
+            members, total = (await session.execute(team_summary_stmt())).one()
+            return {'members': members, 'total_queries': total, 'average': total / members if members else 0.0}
+    
+    async def get_top_users(self, limit: int = 5) -> List[Dict]:
+        async with AsyncSessionLocal() as session:
+            return [member_row(r) for r in await session.execute(top_users_stmt(limit))]
+    
+    async def get_team_page(self, page: int, page_size: int = TEAM_PAGE_SIZE) -> List[Dict]:
+        async with AsyncSessionLocal() as session:
+            return [member_row(r) for r in await session.execute(team_page_stmt(page * page_size, page_size))]
+    
+    async def get_daily_volume(self, days: int = 7) -> List[Dict]:
+        since = datetime.now() - timedelta(days=days - 1)
+        async with AsyncSessionLocal() as session:
+            return [{'day': r[0], 'queries': r[1], 'active_users': r[2]}
+                    for r in await session.execute(daily_volume_stmt(since))]
+    
+    async def refresh_daily_stats(self, days: int = 2):
+        since = datetime.combine((datetime.now() - timedelta(days=days - 1)).date(), datetime.min.time())
+        async with AsyncSessionLocal() as session:
+            for stmt in refresh_daily_stmts(since):
+                await session.execute(stmt)
+            await session.commit()
+    
+    async def iter_queries(self, since: datetime = None, until: datetime = None, user_id: int = None,
+                           chunk_size: int = EXPORT_CHUNK_SIZE):
+        """Async-yield lists of query rows using a server-side cursor"""
+        async with AsyncSessionLocal() as session:
+            result = await session.stream(
+                export_stmt(since, until, user_id).execution_options(yield_per=chunk_size)
+            )
+            async for partition in result.partitions(chunk_size):
+                yield [export_row(r) for r in partition]
+    
+    async def find_user_by_username(self, username: str) -> Optional[int]:
+        async with AsyncSessionLocal() as session:
+            try:
+                result = await session.execute(
+                    select(User.id).where(func.lower(User.username) == username.lower()).limit(1)
+                )
+                return result.scalar()
+            except Exception as e:
+                logger.error(f"DB lookup error: {e}")
+                return None
+
+class SyncStorageAdapter:
+    """Exposes the synchronous DataStorage through the async storage interface.
+
+    Database round-trips run in a worker thread so they never block the event loop.
+    """
+    ASYNC_METHODS = {
+        'init', 'get_user', 'update_user', 'is_team_member', 'increment_usage',
+        'write_usage_batch', 'prune_queries', 'find_user_by_username',
+        'get_team_summary', 'get_top_users', 'get_team_page', 'get_daily_volume', 'refresh_daily_stats'
+    }
+    
+    def __init__(self, backend: DataStorage):
+        self.backend = backend
+    
+    async def iter_queries(self, **filters):
+        batches = self.backend.iter_queries(**filters)
         try:
-            q = Query(user_id=user_id, query=query[:1000], response=response[:1000])
-            session.add(q)
-            session.commit()
-        except:
-            session.rollback()
+            while True:
+                batch = await asyncio.to_thread(next, batches, None)
+                if batch is None:
+                    return
+                yield batch
         finally:
-            session.close()
+            batches.close()
     
-    def get_team_members(self) -> List[Dict]:
-        if engine:
-            session = Session()
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if name not in self.ASYNC_METHODS:
+            return attr
+        
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(attr, *args, **kwargs)
+        return call
+
+storage = AsyncDataStorage() if async_engine else SyncStorageAdapter(DataStorage())
+
+# ============================================================================
+# WRITE-BEHIND QUERY LOG
+# ============================================================================
+class UsageWriter:
+    """Buffers query rows and counter deltas and writes them in batches off the request path"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.rows = []
+        self.deltas = {}
+        self.lock = asyncio.Lock()
+        self.flush_task = None  # size-triggered flush; referenced so it is not garbage-collected
+    
+    def record(self, user_id: int, query: str, response: str):
+        if self.storage.persists_queries:
+            self.rows.append({
+                'user_id': user_id, 'query': query[:1000],
+                'response': response[:1000], 'timestamp': datetime.now()
+            })
+        self.deltas[user_id] = self.deltas.get(user_id, 0) + 1
+        self.storage.adjust_cached_count(user_id, 1)
+        flushing = self.lock.locked() or (self.flush_task and not self.flush_task.done())
+        if len(self.rows) >= QUERY_FLUSH_SIZE and not flushing:
+            self.flush_task = asyncio.create_task(self.flush())
+    
+    async def flush(self):
+        async with self.lock:
+            if not self.rows and not self.deltas:
+                return
+            rows, deltas = self.rows, self.deltas
+            self.rows, self.deltas = [], {}
             try:
-                users = session.query(User).filter_by(is_team=True).all()
-                return [{
-                    'id': u.id, 'username': u.username,
-                    'first_name': u.first_name, 'query_count': u.query_count
-                } for u in users]
-            except:
-                return []
-            finally:
-                session.close()
-        else:
-            return [u for u in self.users.values() if u.get('is_team')]
+                await self.storage.write_usage_batch(rows, deltas)
+            except Exception as e:
+                logger.error(f"Query log flush failed ({len(rows)} rows): {e}")
+                # Keep the data for the next attempt, bounded so a dead DB can't eat memory
+                self.rows = (rows + self.rows)[-QUERY_BUFFER_MAX:]
+                for user_id, delta in deltas.items():
+                    self.deltas[user_id] = self.deltas.get(user_id, 0) + delta
+
+usage_writer = UsageWriter(storage)
+
+async def flush_usage_job(context: ContextTypes.DEFAULT_TYPE):
+    await usage_writer.flush()
 
-storage = DataStorage()
+async def refresh_stats_job(context: ContextTypes.DEFAULT_TYPE):
+    # The first run rebuilds a month of history, later runs only today and yesterday
+    days = context.job.data or 2
+    context.job.data = 2
+    try:
+        await storage.refresh_daily_stats(days)
+    except Exception as e:
+        logger.error(f"Stats refresh error: {e}")
+
+async def prune_queries_job(context: ContextTypes.DEFAULT_TYPE):
+    cutoff = datetime.now() - timedelta(days=QUERY_RETENTION_DAYS)
+    try:
+        removed = await storage.prune_queries(cutoff)
+        if removed:
+            logger.info(f"🧹 Pruned {removed} queries older than {QUERY_RETENTION_DAYS} days")
+    except Exception as e:
+        logger.error(f"Query prune error: {e}")
+
+# ============================================================================
+# QUERY LOG EXPORT
+# ============================================================================
+EXPORT_FIELDS = ['id', 'user_id', 'timestamp', 'query', 'response']
+
+def _write_export_batch(out, fmt: str, rows: List[Dict], writer=None):
+    if fmt == 'csv':
+        writer.writerows(rows)
+    else:
+        out.writelines(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+
+async def export_queries(path: str, fmt: str = 'jsonl', **filters) -> int:
+    """Stream the query log into a gzip-compressed JSONL/CSV file; memory stays constant"""
+    count = 0
+    with gzip.open(path, 'wt', encoding='utf-8', newline='') as out:
+        writer = None
+        if fmt == 'csv':
+            writer = csv.DictWriter(out, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+        async for rows in storage.iter_queries(**filters):
+            await asyncio.to_thread(_write_export_batch, out, fmt, rows, writer)
+            count += len(rows)
+    return count
+
+def parse_export_args(args: List[str]) -> Dict:
+    """/export [YYYY-MM-DD [YYYY-MM-DD]] [user_id] [csv|jsonl]"""
+    options = {'fmt': 'jsonl', 'since': None, 'until': None, 'user_id': None}
+    for arg in args:
+        if arg.lower() in ('csv', 'jsonl'):
+            options['fmt'] = arg.lower()
+        elif arg.isdigit():
+            options['user_id'] = int(arg)
+        else:
+            day = datetime.strptime(arg, '%Y-%m-%d')
+            if options['since'] is None:
+                options['since'] = day
+            else:
+                # Inclusive end date
+                options['until'] = day + timedelta(days=1)
+    return options
 
 # ============================================================================
 # KEYBOARDS
 # ============================================================================
+# Button layout of each reply keyboard (keys into TRANSLATIONS[lang][menu])
+KEYBOARD_LAYOUTS = {
+    'keyboard': [['products', 'clients'], ['templates', 'team'], ['lang', 'reset']],
+    'products_keyboard': [['dvag', 'generali'], ['badenia', 'advocard'], ['back']],
+    'clients_keyboard': [['familia'], ['autonomo'], ['empresa'], ['back']],
+}
+
+def build_keyboards() -> Dict[tuple, ReplyKeyboardMarkup]:
+    """All reply keyboards for every language; markups are immutable, so they are shared"""
+    keyboards = {}
+    for lang, texts in TRANSLATIONS.items():
+        for menu, rows in KEYBOARD_LAYOUTS.items():
+            keyboard = [[KeyboardButton(texts[menu][key]) for key in row] for row in rows]
+            keyboards[(menu, lang)] = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    return keyboards
+
+KEYBOARDS = build_keyboards()
+
 def get_main_keyboard(lang: str = 'es') -> ReplyKeyboardMarkup:
-    kb = TRANSLATIONS[lang]['keyboard']
-    keyboard = [
-        [KeyboardButton(kb['products']), KeyboardButton(kb['clients'])],
-        [KeyboardButton(kb['templates']), KeyboardButton(kb['team'])],
-        [KeyboardButton(kb['lang']), KeyboardButton(kb['reset'])]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    return KEYBOARDS[('keyboard', lang)]
 
 def get_products_keyboard(lang: str = 'es') -> ReplyKeyboardMarkup:
-    kb = TRANSLATIONS[lang]['products_keyboard']
-    keyboard = [
-        [KeyboardButton(kb['dvag']), KeyboardButton(kb['generali'])],
-        [KeyboardButton(kb['badenia']), KeyboardButton(kb['advocard'])],
-        [KeyboardButton(kb['back'])]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    return KEYBOARDS[('products_keyboard', lang)]
 
 def get_clients_keyboard(lang: str = 'es') -> ReplyKeyboardMarkup:
-    kb = TRANSLATIONS[lang]['clients_keyboard']
-    keyboard = [
-        [KeyboardButton(kb['familia'])],
-        [KeyboardButton(kb['autonomo'])],
-        [KeyboardButton(kb['empresa'])],
-        [KeyboardButton(kb['back'])]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    return KEYBOARDS[('clients_keyboard', lang)]
 
 # ============================================================================
 # HELPERS
 # ============================================================================
-def identify_creator(user):
+async def identify_creator(user):
     global CREATOR_ID
     if user.username == CREATOR_USERNAME and CREATOR_ID is None:
-        CREATOR_ID = user.id
-        logger.info(f"✅ Creator: @{user.username} ({user.id})")
+        CREATOR_ID = await state.claim_creator_id(user.id)
+        logger.info(f"✅ Creator: @{user.username} ({CREATOR_ID})")
 
-def is_creator(user_id: int) -> bool:
+async def is_creator(user_id: int) -> bool:
+    global CREATOR_ID
+    if CREATOR_ID is None:
+        # Another worker may have seen the creator first
+        CREATOR_ID = await state.get_creator_id()
     return user_id == CREATOR_ID
 
+async def has_access(user_id: int) -> bool:
+    return await is_creator(user_id) or await storage.is_team_member(user_id)
+
+async def delete_quietly(message):
+    """Delete a status message; it may be missing if sending it failed"""
+    if not isinstance(message, Message):
+        return
+    try:
+        await message.delete()
+    except Exception as e:
+        logger.warning(f"Delete failed: {e}")
+
 # ============================================================================
 # COMMAND HANDLERS
 # ============================================================================
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    identify_creator(user)
+    await identify_creator(user)
     
-    user_data = storage.get_user(user.id)
-    lang = user_data.get('language', 'es')
+    lang = await get_user_language(user.id)
     
-    storage.update_user(user.id, {
+    await storage.update_user(user.id, {
         'username': user.username or '',
         'first_name': user.first_name or '',
         'language': lang
@@ -766,9 +2892,9 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin command for user management only"""
     user_id = update.effective_user.id
-    lang = get_user_language(user_id)
+    lang = await get_user_language(user_id)
     
-    if not is_creator(user_id):
+    if not await is_creator(user_id):
         await update.message.reply_text(get_text(lang, 'admin_only'))
         return
     
@@ -782,6 +2908,7 @@ async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 <b>Información del sistema:</b>
 /docs - Estadísticas base de datos
 /stats - Estadísticas detalladas equipo
+/admin reindex - Reconstruir base de conocimiento
 
 <b>Ejemplos:</b>
 <code>/admin add 123456789</code>
@@ -794,6 +2921,7 @@ async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 <b>Systeminformation:</b>
 /docs - Datenbankstatistiken
 /stats - Detaillierte Team-Statistiken
+/admin reindex - Wissensbasis neu aufbauen
 
 <b>Beispiele:</b>
 <code>/admin add 123456789</code>
@@ -807,47 +2935,44 @@ async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target = context.args[1]
         if target.startswith('@'):
             username = target[1:]
-            if engine:
-                session = Session()
-                try:
-                    user = session.query(User).filter(User.username.ilike(username)).first()
-                    if user:
-                        user.is_team = True
-                        session.commit()
-                        msg = f"✅ @{username} añadido al equipo" if lang == 'es' else f"✅ @{username} zum Team hinzugefügt"
-                        await update.message.reply_text(msg)
-                    else:
-                        msg = f"⚠️ @{username} no encontrado. Debe usar /start primero." if lang == 'es' else f"⚠️ @{username} nicht gefunden. Muss /start verwenden."
-                        await update.message.reply_text(msg)
-                finally:
-                    session.close()
+            target_id = await storage.find_user_by_username(username)
+            if target_id is not None:
+                await storage.update_user(target_id, {'is_team': True})
+                msg = f"✅ @{username} añadido al equipo" if lang == 'es' else f"✅ @{username} zum Team hinzugefügt"
             else:
-                found = False
-                for uid, udata in storage.users.items():
-                    if udata.get('username', '').lower() == username.lower():
-                        storage.update_user(uid, {'is_team': True})
-                        msg = f"✅ @{username} añadido al equipo" if lang == 'es' else f"✅ @{username} zum Team hinzugefügt"
-                        await update.message.reply_text(msg)
-                        found = True
-                        break
-                if not found:
-                    msg = f"⚠️ @{username} no encontrado" if lang == 'es' else f"⚠️ @{username} nicht gefunden"
-                    await update.message.reply_text(msg)
+                msg = f"⚠️ @{username} no encontrado. Debe usar /start primero." if lang == 'es' else f"⚠️ @{username} nicht gefunden. Muss /start verwenden."
+            await update.message.reply_text(msg)
         else:
             try:
                 target_id = int(target)
-                storage.update_user(target_id, {'is_team': True})
+                await storage.update_user(target_id, {'is_team': True})
                 await update.message.reply_text(get_text(lang, 'user_added', id=target_id), parse_mode=ParseMode.HTML)
             except ValueError:
                 msg = "❌ ID inválido" if lang == 'es' else "❌ Ungültige ID"
                 await update.message.reply_text(msg)
+    
+    elif cmd == 'reindex':
+        chat_id = update.effective_chat.id
+        
+        async def report(count, error):
+            if error:
+                msg = f"❌ Reindexado fallido: {error}" if lang == 'es' else f"❌ Neuaufbau fehlgeschlagen: {error}"
+            else:
+                msg = f"✅ Base de conocimiento actualizada: {count:,} chunks" if lang == 'es' else f"✅ Wissensbasis aktualisiert: {count:,} Chunks"
+            await context.bot.send_message(chat_id, msg)
+        
+        if start_reindex(report):
+            msg = "🔧 Reconstruyendo la base de conocimiento en segundo plano..." if lang == 'es' else "🔧 Wissensbasis wird im Hintergrund neu aufgebaut..."
+        else:
+            msg = "⏳ Ya hay una reconstrucción en curso" if lang == 'es' else "⏳ Ein Neuaufbau läuft bereits"
+        await update.message.reply_text(msg)
 
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Help command - available for all team members"""
     user_id = update.effective_user.id
-    lang = get_user_language(user_id)
+    lang = await get_user_language(user_id)
     
-    if not storage.is_team_member(user_id):
+    if not await has_access(user_id):
         await update.message.reply_text(get_text(lang, 'no_access'))
         return
     
@@ -881,7 +3006,7 @@ Escribe tu pregunta directamente:
 "Diferencias entre seguros Generali"
 
 <b>3. Enviar documentos:</b>
-Envía PDF/DOCX/TXT y añade pregunta como caption.
+Envía PDF/DOCX/PPTX/TXT y añade pregunta como caption.
 
 El bot buscará en la base de conocimiento (19,000+ fragmentos) y responderá con fuentes."""
     else:
@@ -914,34 +3039,72 @@ Stelle deine Frage direkt:
 "Unterschiede zwischen Generali Versicherungen"
 
 <b>3. Dokumente senden:</b>
-Sende PDF/DOCX/TXT mit Frage als Caption.
+Sende PDF/DOCX/PPTX/TXT mit Frage als Caption.
 
 Der Bot sucht in der Wissensbasis (19.000+ Fragmente) und antwortet mit Quellen."""
     
-    if is_creator(user_id):
+    if await is_creator(user_id):
         admin_text = """
 
 <b>⚙️ ADMIN:</b>
 /admin add [ID/@user] - Usuario al equipo
 /admin stats - Estadísticas del bot
 /docs - Estadísticas base de datos
-/stats - Estadísticas detalladas""" if lang == 'es' else """
+/stats - Estadísticas detalladas
+/export [desde] [hasta] [user_id] [csv] - Exportar consultas""" if lang == 'es' else """
 
 <b>⚙️ ADMIN:</b>
 /admin add [ID/@user] - Benutzer zum Team
 /admin stats - Bot-Statistiken
 /docs - Datenbankstatistiken
-/stats - Detaillierte Statistiken"""
+/stats - Detaillierte Statistiken
+/export [von] [bis] [user_id] [csv] - Anfragen exportieren"""
         help_text += admin_text
     
     await update.message.reply_text(help_text, parse_mode=ParseMode.HTML)
 
+async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Export command - admin only, sends the query log as a compressed file"""
+    user_id = update.effective_user.id
+    lang = await get_user_language(user_id)
+    
+    if not await is_creator(user_id):
+        await update.message.reply_text(get_text(lang, 'admin_only'))
+        return
+    
+    try:
+        options = parse_export_args(context.args or [])
+    except ValueError:
+        usage = "Uso: /export [desde AAAA-MM-DD] [hasta AAAA-MM-DD] [user_id] [csv|jsonl]" if lang == 'es' \
+            else "Nutzung: /export [von JJJJ-MM-TT] [bis JJJJ-MM-TT] [user_id] [csv|jsonl]"
+        await update.message.reply_text(usage)
+        return
+    
+    fmt = options.pop('fmt')
+    await usage_writer.flush()
+    await update.message.chat.send_action("upload_document")
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}.gz")
+    os.close(fd)
+    try:
+        count = await export_queries(path, fmt, **options)
+        filename = f"queries_{datetime.now():%Y%m%d_%H%M}.{fmt}.gz"
+        with open(path, 'rb') as f:
+            await update.message.reply_document(
+                document=f, filename=filename,
+                caption=f"📤 {count:,} consultas" if lang == 'es' else f"📤 {count:,} Anfragen"
+            )
+    except Exception as e:
+        logger.error(f"Export error: {e}")
+        await update.message.reply_text(get_text(lang, 'error', error=str(e)[:30]))
+    finally:
+        os.remove(path)
+
 async def cmd_docs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Docs command - available only for admin"""
     user_id = update.effective_user.id
-    lang = get_user_language(user_id)
+    lang = await get_user_language(user_id)
     
-    if not is_creator(user_id):
+    if not await is_creator(user_id):
         await update.message.reply_text(get_text(lang, 'admin_only'))
         return
     
@@ -983,15 +3146,18 @@ Berater können Fragen stellen und der Bot sucht automatisch in diesen Dokumente
 async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Stats command - available only for admin"""
     user_id = update.effective_user.id
-    lang = get_user_language(user_id)
+    lang = await get_user_language(user_id)
     
-    if not is_creator(user_id):
+    if not await is_creator(user_id):
         await update.message.reply_text(get_text(lang, 'admin_only'))
         return
     
-    team = storage.get_team_members()
+    summary, top_users, volume = await asyncio.gather(
+        storage.get_team_summary(),
+        storage.get_top_users(5),
+        storage.get_daily_volume(7)
+    )
     uptime = datetime.now() - BOT_START_TIME
-    total_queries = sum(m.get('query_count', 0) for m in team)
     doc_count = collection.count() if collection else 0
     
     if lang == 'es':
@@ -1000,7 +3166,7 @@ async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 <b>Sistema:</b>
 • Versión: {BOT_VERSION}
 • Uptime: {uptime.days}d {uptime.seconds//3600}h {(uptime.seconds%3600)//60}m
-• Base de datos: {'PostgreSQL ✅' if engine else 'JSON (local)'}
+• Base de datos: {storage.backend_name} ✅
 • AI: Gemini 2.5 Flash ✅
 
 <b>Base de conocimiento:</b>
@@ -1009,22 +3175,24 @@ async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Estado: {'✅ Activa' if doc_count > 0 else '❌ Vacía'}
 
 <b>Equipo:</b>
-• Miembros: {len(team)}
-• Consultas totales: {total_queries:,}
-• Promedio: {(total_queries / len(team) if team else 0):.1f} por miembro
+• Miembros: {summary['members']}
+• Consultas totales: {summary['total_queries']:,}
+• Promedio: {summary['average']:.1f} por miembro
 
 <b>Top usuarios:</b>"""
         
-        sorted_team = sorted(team, key=lambda x: x.get('query_count', 0), reverse=True)[:5]
-        for i, m in enumerate(sorted_team, 1):
-            stats_text += f"\n{i}. {m['first_name']} - {m.get('query_count', 0)} consultas"
+        for i, m in enumerate(top_users, 1):
+            stats_text += f"\n{i}. {m['first_name']} - {m['query_count']} consultas"
+        stats_text += "\n\n<b>Últimos 7 días:</b>"
+        for d in volume:
+            stats_text += f"\n• {d['day']:%d.%m}: {d['queries']} consultas ({d['active_users']} usuarios)"
     else:
         stats_text = f"""<b>📊 DETAILLIERTE STATISTIKEN</b>
 
 <b>System:</b>
 • Version: {BOT_VERSION}
 • Uptime: {uptime.days}d {uptime.seconds//3600}h {(uptime.seconds%3600)//60}m
-• Datenbank: {'PostgreSQL ✅' if engine else 'JSON (lokal)'}
+• Datenbank: {storage.backend_name} ✅
 • AI: Gemini 2.5 Flash ✅
 
 <b>Wissensbasis:</b>
@@ -1033,57 +3201,87 @@ async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Status: {'✅ Aktiv' if doc_count > 0 else '❌ Leer'}
 
 <b>Team:</b>
-• Mitglieder: {len(team)}
-• Gesamtanfragen: {total_queries:,}
-• Durchschnitt: {(total_queries / len(team) if team else 0):.1f} pro Mitglied
+• Mitglieder: {summary['members']}
+• Gesamtanfragen: {summary['total_queries']:,}
+• Durchschnitt: {summary['average']:.1f} pro Mitglied
 
 <b>Top Benutzer:</b>"""
         
-        sorted_team = sorted(team, key=lambda x: x.get('query_count', 0), reverse=True)[:5]
-        for i, m in enumerate(sorted_team, 1):
-            stats_text += f"\n{i}. {m['first_name']} - {m.get('query_count', 0)} Anfragen"
+        for i, m in enumerate(top_users, 1):
+            stats_text += f"\n{i}. {m['first_name']} - {m['query_count']} Anfragen"
+        stats_text += "\n\n<b>Letzte 7 Tage:</b>"
+        for d in volume:
+            stats_text += f"\n• {d['day']:%d.%m}: {d['queries']} Anfragen ({d['active_users']} Benutzer)"
     
     await update.message.reply_text(stats_text, parse_mode=ParseMode.HTML)
 
 async def cmd_team(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Team command - available for all team members"""
     user_id = update.effective_user.id
-    lang = get_user_language(user_id)
+    lang = await get_user_language(user_id)
     
-    if not storage.is_team_member(user_id):
+    if not await has_access(user_id):
         await update.message.reply_text(get_text(lang, 'no_access'))
         return
     
-    team = storage.get_team_members()
+    page = int(context.args[0]) - 1 if context.args and context.args[0].isdigit() else 0
+    text, markup = await render_team_page(lang, max(page, 0))
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+
+async def render_team_page(lang: str, page: int):
+    """One page of the team list plus prev/next buttons"""
+    summary, members = await asyncio.gather(
+        storage.get_team_summary(),
+        storage.get_team_page(page, TEAM_PAGE_SIZE)
+    )
+    total = summary['members']
     
-    if not team:
+    if not total:
         no_members = "👥 Aún no hay miembros en el equipo." if lang == 'es' else "👥 Noch keine Teammitglieder."
-        await update.message.reply_text(no_members)
-        return
+        return no_members, None
     
+    pages = (total + TEAM_PAGE_SIZE - 1) // TEAM_PAGE_SIZE
     if lang == 'es':
-        members_text = f"<b>👔 EQUIPO OSCAR CASCO</b> ({len(team)} miembros)\n\n"
-        for i, m in enumerate(team, 1):
-            name = m.get('first_name', 'N/A')
-            username = m.get('username', 'N/A')
-            queries = m.get('query_count', 0)
-            members_text += f"{i}. <b>{name}</b> (@{username})\n   📊 {queries} consultas\n\n"
+        members_text = f"<b>👔 EQUIPO OSCAR CASCO</b> ({total} miembros)\n\n"
+        unit = "consultas"
     else:
-        members_text = f"<b>👔 TEAM OSCAR CASCO</b> ({len(team)} Mitglieder)\n\n"
-        for i, m in enumerate(team, 1):
-            name = m.get('first_name', 'N/A')
-            username = m.get('username', 'N/A')
-            queries = m.get('query_count', 0)
-            members_text += f"{i}. <b>{name}</b> (@{username})\n   📊 {queries} Anfragen\n\n"
+        members_text = f"<b>👔 TEAM OSCAR CASCO</b> ({total} Mitglieder)\n\n"
+        unit = "Anfragen"
+    for i, m in enumerate(members, page * TEAM_PAGE_SIZE + 1):
+        members_text += f"{i}. <b>{m['first_name']}</b> (@{m['username']})\n   📊 {m['query_count']} {unit}\n\n"
     
-    await update.message.reply_text(members_text, parse_mode=ParseMode.HTML)
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"team_page_{page - 1}"))
+    if pages > 1:
+        buttons.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"team_page_{page}"))
+    if page + 1 < pages:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"team_page_{page + 1}"))
+    return members_text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def callback_team(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /team pagination buttons"""
+    query = update.callback_query
+    await query.answer()
+    
+    user_id = query.from_user.id
+    if not await has_access(user_id):
+        return
+    
+    lang = await get_user_language(user_id)
+    text, markup = await render_team_page(lang, int(query.data.rsplit('_', 1)[1]))
+    try:
+        await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+    except Exception as e:
+        # Tapping the current page indicator leaves the message unchanged
+        logger.debug(f"Team page unchanged: {e}")
 
 async def cmd_lang(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Language selection for all team members"""
     user_id = update.effective_user.id
-    lang = get_user_language(user_id)
+    lang = await get_user_language(user_id)
     
-    if not storage.is_team_member(user_id):
+    if not await has_access(user_id):
         await update.message.reply_text(get_text(lang, 'no_access'))
         return
     
@@ -1109,8 +3307,8 @@ async def callback_lang(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
     new_lang = query.data.split('_')[1]
     
-    set_user_language(user_id, new_lang)
-    storage.update_user(user_id, {'language': new_lang})
+    await set_user_language(user_id, new_lang)
+    await storage.update_user(user_id, {'language': new_lang})
     
     lang_name = "Español 🇪🇸" if new_lang == 'es' else "Deutsch 🇩🇪"
     await query.edit_message_text(
@@ -1123,20 +3321,87 @@ async def callback_lang(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    lang = get_user_language(user_id)
-    clear_chat_session(user_id)
+    lang = await get_user_language(user_id)
+    
+    if not await has_access(user_id):
+        await update.message.reply_text(get_text(lang, 'no_access'))
+        return
+    
+    await clear_chat_session(user_id)
+    doc_index.drop(user_id)
     await update.message.reply_text(get_text(lang, 'cleared'))
 
+# ============================================================================
+# MENU ROUTING
+# ============================================================================
+def reply_menu(text_key: str, keyboard: str = None):
+    """Menu action: answer with a translated text, optionally opening another keyboard"""
+    async def action(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str):
+        await update.message.reply_text(
+            get_text(lang, text_key),
+            parse_mode=ParseMode.HTML,
+            reply_markup=KEYBOARDS[(keyboard, lang)] if keyboard else None
+        )
+    return action
+
+def run_command(handler):
+    """Menu action: behave like the equivalent /command"""
+    async def action(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str):
+        await handler(update, context)
+    return action
+
+async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE, lang: str):
+    await update.message.reply_text("📱", reply_markup=get_main_keyboard(lang))
+
+# (keyboard, button key) -> action; a new button is a TRANSLATIONS label, a layout entry and a line here
+MENU_ACTIONS = {
+    ('keyboard', 'products'): reply_menu('main_menu_msg', 'products_keyboard'),
+    ('keyboard', 'clients'): reply_menu('main_menu_msg', 'clients_keyboard'),
+    ('keyboard', 'templates'): reply_menu('templates_msg'),
+    ('keyboard', 'team'): run_command(cmd_team),
+    ('keyboard', 'lang'): run_command(cmd_lang),
+    ('keyboard', 'reset'): run_command(cmd_reset),
+    ('products_keyboard', 'dvag'): reply_menu('product_dvag'),
+    ('products_keyboard', 'generali'): reply_menu('product_generali'),
+    ('products_keyboard', 'badenia'): reply_menu('product_badenia'),
+    ('products_keyboard', 'advocard'): reply_menu('product_advocard'),
+    ('products_keyboard', 'back'): back_to_main,
+    ('clients_keyboard', 'familia'): reply_menu('client_familia'),
+    ('clients_keyboard', 'autonomo'): reply_menu('client_autonomo'),
+    ('clients_keyboard', 'empresa'): reply_menu('client_empresa'),
+    ('clients_keyboard', 'back'): back_to_main,
+}
+
+def build_menu_routes() -> Dict[str, Dict[str, Callable]]:
+    """Button text -> {language: action}; a label shared by both languages (e.g. 'DVAG') has two"""
+    routes = {}
+    for lang, texts in TRANSLATIONS.items():
+        for (menu, key), action in MENU_ACTIONS.items():
+            routes.setdefault(texts[menu][key], {})[lang] = action
+    return routes
+
+MENU_ROUTES = build_menu_routes()
+
+async def route_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, user_lang: str) -> bool:
+    """Run the action of a menu button; False when `text` is not one"""
+    actions = MENU_ROUTES.get(text)
+    if not actions:
+        return False
+    # The label tells the language, except for labels shared by both (e.g. 'DVAG')
+    lang = user_lang if user_lang in actions else next(iter(actions))
+    await actions[lang](update, context, lang)
+    return True
+
 # ============================================================================
 # MESSAGE HANDLERS
 # ============================================================================
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    identify_creator(user)
+    await identify_creator(user)
     user_id = user.id
-    lang = get_user_language(user_id)
+    lang = await get_user_language(user_id)
     
-    if not storage.is_team_member(user_id):
+    if not await has_access(user_id):
         await update.message.reply_text(get_text(lang, 'no_access'))
         return
     
@@ -1144,22 +3409,45 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     filename = document.file_name
     file_ext = Path(filename).suffix.lower()
     
-    if file_ext not in ['.pdf', '.docx', '.doc', '.txt']:
-        await update.message.reply_text("⚠️ Solo PDF, DOCX o TXT")
+    if file_ext not in SUPPORTED_UPLOADS:
+        await update.message.reply_text("⚠️ Solo PDF, DOCX, PPTX o TXT")
+        return
+    
+    if document.file_size and document.file_size > UPLOAD_MAX_BYTES:
+        await update.message.reply_text(get_text(lang, 'file_too_large', limit=UPLOAD_MAX_BYTES // (1024 * 1024)))
         return
     
     caption = update.message.caption or ""
+    cached = upload_cache.get(document.file_unique_id)
+    if cached and cached.answer(user_id, caption, lang) is not None:
+        # Same user, file and question as before: no download, parsing or LLM call
+        response = await process_file(cached, filename, query=caption, user_id=user_id)
+        usage_writer.record(user_id, f"[FILE: {filename}] {caption}", response)
+        await update.message.reply_text(
+            get_text(lang, 'file_processed', filename=filename, response=response),
+            parse_mode=ParseMode.HTML
+        )
+        return
+    
+    wait = scheduler.check_rate(user_id)
+    if wait:
+        await update.message.reply_text(get_text(lang, 'rate_limited', seconds=int(wait) + 1))
+        return
+    
     await update.message.chat.send_action("typing")
     processing_msg = await update.message.reply_text(get_text(lang, 'thinking'))
     
+    async def show_position(position: int):
+        await processing_msg.edit_text(get_text(lang, 'queued', position=position))
+    
+    async def work():
+        upload = await load_upload(context.bot, document)
+        return await process_file(upload, filename, query=caption, user_id=user_id)
+    
     try:
-        file = await context.bot.get_file(document.file_id)
-        file_bytes = await file.download_as_bytearray()
-        response = await process_file(bytes(file_bytes), filename, query=caption, user_id=user_id)
+        response = await scheduler.run(user_id, work, show_position)
         
-        storage.save_query(user_id, f"[FILE: {filename}] {caption}", response)
-        user_data = storage.get_user(user_id)
-        storage.update_user(user_id, {'query_count': user_data.get('query_count', 0) + 1})
+        usage_writer.record(user_id, f"[FILE: {filename}] {caption}", response)
         
         await processing_msg.delete()
         await update.message.reply_text(
@@ -1173,125 +3461,312 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    identify_creator(user)
+    await identify_creator(user)
     user_id = user.id
     text = update.message.text
     
-    user_data = storage.get_user(user_id)
-    current_lang = user_data.get('language', 'es')
+    current_lang = await get_user_language(user_id)
     
-    if not storage.is_team_member(user_id):
+    if not await has_access(user_id):
         await update.message.reply_text(get_text(current_lang, 'no_access'))
         return
     
-    # Auto-detect language
-    detected_lang = detect_language(text)
-    if detected_lang != current_lang and len(text) > 15:
-        set_user_language(user_id, detected_lang)
-        storage.update_user(user_id, {'language': detected_lang})
-        current_lang = detected_lang
-    
-    # Handle keyboard buttons
-    kb_main = TRANSLATIONS[current_lang]['keyboard']
-    kb_products = TRANSLATIONS[current_lang]['products_keyboard']
-    kb_clients = TRANSLATIONS[current_lang]['clients_keyboard']
-    
-    # Main menu
-    if text == kb_main['products']:
-        await update.message.reply_text(
-            get_text(current_lang, 'main_menu_msg'),
-            parse_mode=ParseMode.HTML,
-            reply_markup=get_products_keyboard(current_lang)
-        )
-        return
-    elif text == kb_main['clients']:
-        await update.message.reply_text(
-            get_text(current_lang, 'main_menu_msg'),
-            parse_mode=ParseMode.HTML,
-            reply_markup=get_clients_keyboard(current_lang)
-        )
-        return
-    elif text == kb_main['templates']:
-        await update.message.reply_text(
-            get_text(current_lang, 'templates_msg'),
-            parse_mode=ParseMode.HTML
-        )
-        return
-    elif text == kb_main['team']:
-        await cmd_team(update, context)
-        return
-    elif text == kb_main['lang']:
-        await cmd_lang(update, context)
-        return
-    elif text == kb_main['reset']:
-        await cmd_reset(update, context)
-        return
-    
-    # Products submenu
-    elif text == kb_products['dvag']:
-        await update.message.reply_text(get_text(current_lang, 'product_dvag'), parse_mode=ParseMode.HTML)
-        return
-    elif text == kb_products['generali']:
-        await update.message.reply_text(get_text(current_lang, 'product_generali'), parse_mode=ParseMode.HTML)
-        return
-    elif text == kb_products['badenia']:
-        await update.message.reply_text(get_text(current_lang, 'product_badenia'), parse_mode=ParseMode.HTML)
-        return
-    elif text == kb_products['advocard']:
-        await update.message.reply_text(get_text(current_lang, 'product_advocard'), parse_mode=ParseMode.HTML)
-        return
-    elif text == kb_products['back']:
-        await update.message.reply_text("📱", reply_markup=get_main_keyboard(current_lang))
+    # Menu buttons: answered from the routing table, without language detection
+    if await route_menu(update, context, text, current_lang):
         return
     
-    # Clients submenu
-    elif text == kb_clients['familia']:
-        await update.message.reply_text(get_text(current_lang, 'client_familia'), parse_mode=ParseMode.HTML)
-        return
-    elif text == kb_clients['autonomo']:
-        await update.message.reply_text(get_text(current_lang, 'client_autonomo'), parse_mode=ParseMode.HTML)
-        return
-    elif text == kb_clients['empresa']:
-        await update.message.reply_text(get_text(current_lang, 'client_empresa'), parse_mode=ParseMode.HTML)
-        return
-    elif text == kb_clients['back']:
-        await update.message.reply_text("📱", reply_markup=get_main_keyboard(current_lang))
-        return
+    # Auto-detect language
+    detected_lang = language_switch(user_id, text, current_lang)
+    if detected_lang:
+        await set_user_language(user_id, detected_lang)
+        await storage.update_user(user_id, {'language': detected_lang})
+        current_lang = detected_lang
     
     # Regular query
     if text and not text.startswith('/'):
-        await update.message.chat.send_action("typing")
-        thinking_msg = await update.message.reply_text(get_text(current_lang, 'thinking'))
+        wait = scheduler.check_rate(user_id)
+        if wait:
+            await update.message.reply_text(get_text(current_lang, 'rate_limited', seconds=int(wait) + 1))
+            return
+        
+        queue_notices = []
+        
+        async def show_position(position: int):
+            queue_notices.append(await update.message.reply_text(get_text(current_lang, 'queued', position=position)))
+        
+        # Start retrieval + generation right away and overlap it with the UI round-trips
+        answer_task = asyncio.create_task(answer_query(text, user_id, show_position))
+        _, thinking_msg = await asyncio.gather(
+            update.message.chat.send_action("typing"),
+            update.message.reply_text(get_text(current_lang, 'thinking')),
+            return_exceptions=True
+        )
         
         try:
-            context_docs = search_knowledge(text)
-            response = await generate_response(text, user_id=user_id, context_docs=context_docs)
-            
-            storage.save_query(user_id, text, response)
-            user = storage.get_user(user_id)
-            storage.update_user(user_id, {'query_count': user.get('query_count', 0) + 1})
-            
-            await thinking_msg.delete()
-            await update.message.reply_text(response, parse_mode=ParseMode.HTML)
-            
+            response = await answer_task
+            await asyncio.gather(
+                update.message.reply_text(response, parse_mode=ParseMode.HTML),
+                delete_quietly(thinking_msg),
+                *[delete_quietly(msg) for msg in queue_notices]
+            )
         except Exception as e:
-            await thinking_msg.delete()
+            await asyncio.gather(delete_quietly(thinking_msg), *[delete_quietly(msg) for msg in queue_notices])
             logger.error(f"Message error: {e}")
             await update.message.reply_text(get_text(current_lang, 'error', error=str(e)[:30]))
+            return
+        
+        # Bookkeeping happens after the user already has the answer
+        usage_writer.record(user_id, text, response)
+
+# ============================================================================
+# UPDATE PROCESSING
+# ============================================================================
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates from different users in parallel, one user's updates strictly in order"""
+    
+    def __init__(self, max_concurrent_updates: int):
+        # The base class holds its semaphore while an update waits for its user's lock,
+        # so one busy user could fill it; leave it unbounded and let `slots` bound running work
+        super().__init__(sys.maxsize)
+        self.slots = asyncio.Semaphore(max_concurrent_updates)
+        self.user_locks = {}
+    
+    @staticmethod
+    def sequence_key(update: object) -> Optional[int]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+    
+    async def do_process_update(self, update: object, coroutine: Awaitable):
+        key = self.sequence_key(update)
+        if key is None:
+            async with self.slots:
+                await coroutine
+            return
+        
+        # [lock, waiters]; asyncio.Lock wakes waiters in FIFO order
+        entry = self.user_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self.slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.user_locks[key]
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+# ============================================================================
+# WARM-UP
+# ============================================================================
+warmup_done = asyncio.Event()  # set once a non-empty knowledge base is open (and warmed up)
+
+def warmup_queries() -> List[str]:
+    """Example questions from the templates message and the product / client menu topics"""
+    queries = []
+    for lang, texts in TRANSLATIONS.items():
+        queries += re.findall(r'"([^"]+)"', texts['templates_msg'])
+        for menu, prefix in (('products_keyboard', 'product'), ('clients_keyboard', 'client')):
+            for key, label in texts[menu].items():
+                if key == 'back':
+                    continue
+                name = label.split(' ', 1)[-1]  # drop the emoji
+                queries.append(name)
+                for topic in re.findall(r'^• (.+)$', texts.get(f'{prefix}_{key}', ''), re.MULTILINE):
+                    queries.append(f"{name}: {topic}")
+    return list(dict.fromkeys(queries))
+
+def index_chunks() -> Optional[int]:
+    """Chunks in the serving index; None while it is opening or unavailable"""
+    if not knowledge_ready.is_set() or collection is None:
+        return None
+    try:
+        return collection.count()
+    except Exception:
+        return None
+
+def touch_index():
+    """First query loads the embedding model and maps the HNSW index into memory"""
+    collection.query(query_texts=["DVAG"], n_results=1)
+
+async def warm_up():
+    """Preload what the first questions after a deploy would otherwise pay for, then mark ready.
+
+    An empty knowledge base is not ready: the background build calls this again after the swap.
+    """
+    await knowledge_ready.wait()
+    if not index_chunks():
+        logger.info("📚 Knowledge base empty, not ready yet")
+        return
+    if WARMUP_ENABLED:
+        await warm_index()
+    warmup_done.set()
+
+async def warm_index():
+    try:
+        await timed('embedding model', asyncio.to_thread(touch_index))
+        queries = warmup_queries()
+        # One at a time so early user questions are not stuck behind a burst of warm-up searches
+        started = time.perf_counter()
+        for query in queries:
+            await retrieve(query)
+        startup_timings['retrieval cache'] = time.perf_counter() - started
+        logger.info(
+            f"🔥 Warm-up done: model {startup_timings['embedding model']:.2f}s, "
+            f"{len(queries)} queries {startup_timings['retrieval cache']:.2f}s"
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ Warm-up failed: {e}")
+
+# ============================================================================
+# WEBHOOK SERVER
+# ============================================================================
+def build_webhook_app(application: Application) -> web.Application:
+    """aiohttp app that feeds Telegram updates into the Application's update queue.
+
+    Recorded updates can be replayed locally with e.g.
+    curl -H 'X-Telegram-Bot-Api-Secret-Token: <secret>' -d @update.json localhost:8080/telegram
+    """
+    async def handle_update(request: web.Request) -> web.Response:
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if WEBHOOK_SECRET and not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            logger.warning(f"Bad webhook payload: {e}")
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response()
+    
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({
+            'status': 'ok',
+            'version': BOT_VERSION,
+            'ready': warmup_done.is_set(),
+            'index_chunks': index_chunks(),
+            'index_building': bool(reindex_task and not reindex_task.done()),
+        })
+    
+    async def ready(request: web.Request) -> web.Response:
+        # For load balancers: 503 until a non-empty knowledge base is open and warmed up
+        return web.json_response({'ready': warmup_done.is_set()}, status=200 if warmup_done.is_set() else 503)
+    
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    app.router.add_get('/healthz', health)
+    app.router.add_get('/readyz', ready)
+    return app
+
+async def run_webhook(application: Application):
+    """Serve updates over HTTP instead of long polling"""
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    
+    if WEBHOOK_URL:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=False
+        )
+        logger.info(f"✅ Webhook registered: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    
+    runner = web.AppRunner(build_webhook_app(application))
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+    logger.info(f"✅ Listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
 
 # ============================================================================
 # MAIN
 # ============================================================================
+startup_timings = {}
+knowledge_task = None
+
+async def timed(name: str, awaitable):
+    """Await a startup step and record how long it took"""
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        startup_timings[name] = time.perf_counter() - started
+
+async def load_knowledge():
+    try:
+        await timed('knowledge', asyncio.to_thread(open_knowledge_base))
+    finally:
+        knowledge_ready.set()
+    logger.info(f"⏱️ Knowledge base ready in {startup_timings['knowledge']:.2f}s")
+    if INDEX_AUTO_BUILD and (collection is None or collection.count() == 0):
+        logger.info("📚 Knowledge base is empty, building it in the background")
+        start_reindex()
+    await warm_up()
+
+async def on_startup(application: Application):
+    global knowledge_task
+    # Questions wait for the knowledge base (see retrieve()); everything else can be served now
+    knowledge_task = asyncio.create_task(load_knowledge())
+    await asyncio.gather(
+        timed('database', storage.init()),
+        timed('gemini', asyncio.to_thread(load_genai)),
+    )
+    steps = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in startup_timings.items())
+    logger.info(f"⏱️ Accepting updates {time.perf_counter() - STARTUP_STARTED:.2f}s after start ({steps})")
+
+async def on_shutdown(application: Application):
+    if index_build_process and index_build_process.returncode is None:
+        index_build_process.terminate()
+    upload_executor.shutdown(wait=False, cancel_futures=True)
+    await usage_writer.flush()
+    logger.info("✅ Query log drained")
+    if async_engine:
+        await async_engine.dispose()
+    await state.close()
+
 def main():
     logger.info("=" * 60)
     logger.info(f"🤖 PIPILA v{BOT_VERSION}")
     logger.info("=" * 60)
     
-    chunks = collection.count() if collection else 0
-    logger.info(f"📚 Knowledge: {chunks} chunks")
-    logger.info(f"🗄️ DB: {'PostgreSQL' if engine else 'JSON'}")
+    startup_timings['import'] = time.perf_counter() - STARTUP_STARTED
+    logger.info(f"⏱️ Module loaded in {startup_timings['import']:.2f}s")
+    logger.info(f"🗄️ DB: {storage.backend_name} ({'async' if async_engine else 'sync'})")
+    logger.info(f"🧠 State: {state.name}")
     
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # Commands
     application.add_handler(CommandHandler("start", cmd_start))
@@ -1302,18 +3777,31 @@ def main():
     application.add_handler(CommandHandler("lang", cmd_lang))
     application.add_handler(CommandHandler("admin", cmd_admin))
     application.add_handler(CommandHandler("reset", cmd_reset))
+    application.add_handler(CommandHandler("export", cmd_export))
     
     # Callbacks
     application.add_handler(CallbackQueryHandler(callback_lang, pattern="^lang_"))
+    application.add_handler(CallbackQueryHandler(callback_team, pattern="^team_page_"))
     
     # Messages
     application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
+    # Background jobs
+    application.job_queue.run_repeating(flush_usage_job, interval=QUERY_FLUSH_INTERVAL, first=QUERY_FLUSH_INTERVAL)
+    application.job_queue.run_repeating(refresh_stats_job, interval=STATS_REFRESH_INTERVAL, first=5, data=30)
+    if QUERY_RETENTION_DAYS > 0:
+        application.job_queue.run_repeating(prune_queries_job, interval=QUERY_PRUNE_INTERVAL, first=60)
+    application.job_queue.run_repeating(expire_upload_indexes_job, interval=600, first=600)
+    application.job_queue.run_repeating(follow_index_job, interval=INDEX_FOLLOW_INTERVAL, first=INDEX_FOLLOW_INTERVAL)
+    
     logger.info("✅ Bot started")
     logger.info("=" * 60)
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+    if BOT_MODE == 'webhook':
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
 
 if __name__ == '__main__':
     main()